@@ -1,3 +1,10 @@
-"""The BangOlufsen Platform"""
-
-DOMAIN="bangolufsen"
+"""The BangOlufsen Platform"""
+
+DOMAIN="bangolufsen"
+# hass.data[DOMAIN] keys: MLGateway by gateway id ("host:port")
+DATA_GATEWAYS = 'gateways'
+# the Store holding the gateway serial numbers and device lists, and its contents
+DATA_STORE = 'store'
+DATA_IDENTITIES = 'identities'
+# EventSubscriptions for Light/Control and virtual button events (see subscriptions.py)
+DATA_SUBSCRIPTIONS = 'subscriptions'
@@ -0,0 +1,288 @@
+"""
+Decoding of many telegrams at once, for the analysis of large telegram logs.
+
+decode_batch() takes a buffer of concatenated telegrams, decode_capture() a capture file (see capture.py). Both
+return TelegramColumns: one column per field instead of one message per telegram,
+
+    timestamp   seconds, wall clock for a capture, NaN when not known
+    direction   capture.RECEIVED or capture.SENT
+    type        payload type
+    mln         MLN, Light/Control room or virtual button number
+    command     Beo4 command code, or the virtual button action
+    source      selected source code of a Source Status or BeoRemote One source selection
+    volume      volume of a Pict&Snd Status
+
+Fields a telegram does not have are NONE (-1). With NumPy installed the columns are the fields of one NumPy
+structured array, and the fields are picked out of the buffer for all the telegrams of a type at once. Without it
+they are array.array columns, filled by a plain loop.
+
+Names are looked up per column from tables built from payloadtypedict, beo4commanddict and selectedsourcedict:
+
+    columns = decode_capture('mlgw_capture.bin')
+    for when, command in zip(columns.timestamp, columns.command_names()):
+        ...
+
+"""
+import argparse
+import math
+import time
+from array import array
+
+from .capture import MAGIC, RECEIVED, SENT, SESSION, _RECORD, _WALL_CLOCK
+from .mlgw import (HEADER_SIZE, SOH, _BEO4COMMAND_STR, _PAYLOADTYPE_STR, _SELECTEDSOURCE_STR,
+                   _VIRTUALACTION_STR)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NONE = -1
+
+_VIRTUAL_BUTTON = 0x20
+_PRESS = 0x01
+
+# Position of each column's field in a telegram, by payload type. 0: the type does not have the field.
+def _positions( fields ):
+    return tuple(fields.get(i, 0) for i in range(256))
+
+_MLN_AT = _positions({0x01: 4, 0x02: 4, 0x03: 4, 0x04: 4, 0x06: 4, 0x07: 4, 0x20: 4})
+_COMMAND_AT = _positions({0x01: 6, 0x04: 6, 0x06: 5, 0x20: 5})
+_SOURCE_AT = _positions({0x02: 5, 0x07: 5})
+_VOLUME_AT = _positions({0x03: 7})
+
+# Name lookup tables: one entry per code, and None as the last entry, which is where NONE (-1) indexes
+TYPE_NAMES = _PAYLOADTYPE_STR + (None,)
+COMMAND_NAMES = _BEO4COMMAND_STR + (None,)
+ACTION_NAMES = _VIRTUALACTION_STR + (None,)
+SOURCE_NAMES = _SELECTEDSOURCE_STR + (None,)
+
+_DTYPE = [('timestamp', 'f8'), ('direction', 'u1'), ('type', 'u1'),
+          ('mln', 'i2'), ('command', 'i2'), ('source', 'i2'), ('volume', 'i2')]
+
+
+"""
+TelegramColumns holds the decoded columns of a batch of telegrams. `records` is the NumPy structured array the
+columns are taken from, None without NumPy. `discarded` counts the bytes of the buffer that were not part of a
+telegram.
+
+"""
+class TelegramColumns:
+    def __init__(self, timestamp, direction, type, mln, command, source, volume, records=None, discarded=0):
+        self.timestamp = timestamp
+        self.direction = direction
+        self.type = type
+        self.mln = mln
+        self.command = command
+        self.source = source
+        self.volume = volume
+        self.records = records
+        self.discarded = discarded
+
+    def __len__(self):
+        return len(self.type)
+
+    def type_names(self):
+        return _lookup(TYPE_NAMES, self.type)
+
+    ## Beo4 command names, and the action names of virtual button events
+    def command_names(self):
+        names = _lookup(COMMAND_NAMES, self.command)
+        if np is not None and self.records is not None:
+            buttons = self.type == _VIRTUAL_BUTTON
+            names[buttons] = _lookup(ACTION_NAMES, self.command[buttons])
+            return names
+        for i, msg_type in enumerate(self.type):
+            if msg_type == _VIRTUAL_BUTTON:
+                names[i] = ACTION_NAMES[self.command[i]]
+        return names
+
+    def source_names(self):
+        return _lookup(SOURCE_NAMES, self.source)
+
+    ## Number of telegrams of each payload type, by name
+    def type_counts(self):
+        if self.records is not None:
+            counts = np.bincount(self.type, minlength=256).tolist()
+        else:
+            counts = [0] * 256
+            for msg_type in self.type:
+                counts[msg_type] += 1
+        return {TYPE_NAMES[msg_type]: count for msg_type, count in enumerate(counts) if count}
+
+
+def _lookup( names, codes ):
+    if np is not None and not isinstance(codes, array):
+        return np.array(names, dtype=object)[codes]
+    return [names[code] for code in codes]
+
+
+## Decode a buffer (bytes, bytearray or memoryview) of concatenated telegrams
+#
+#   Bytes before an SOH byte and a telegram cut short at the end are skipped. timestamps, if given, holds one
+#   timestamp per telegram found.
+#
+def decode_batch( buffer, timestamps=None, direction=RECEIVED ):
+    offsets, discarded = _frame(buffer)
+    if timestamps is None:
+        timestamps = array('d', [math.nan]) * len(offsets)
+    elif len(timestamps) != len(offsets):
+        raise ValueError("%d timestamps for %d telegrams" % (len(timestamps), len(offsets)))
+    directions = array('B', [direction]) * len(offsets)
+    return _columns(buffer, offsets, timestamps, directions, discarded)
+
+
+## Decode the telegrams of a capture file. kinds: the directions to decode, RECEIVED and / or SENT.
+#
+#   Timestamps are wall clock times, from the start time of the session each telegram was captured in.
+#
+def decode_capture( path, kinds=(RECEIVED, SENT) ):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a telegram capture" % path)
+    records = _walk_records(data)
+    if np is not None:
+        offsets, timestamps, directions = _numpy_capture_fields(data, records, kinds)
+    else:
+        offsets, timestamps, directions = _capture_fields(data, records, kinds)
+    return _columns(data, offsets, timestamps, directions)
+
+
+## Offsets of the records of a capture, without the record cut short by a crash, if any
+def _walk_records( data ):
+    records = array('q')
+    append = records.append
+    size = len(data)
+    record_size = _RECORD.size
+    length_at = record_size - 2
+    offset = len(MAGIC)
+    while offset + record_size <= size:
+        append(offset)
+        offset += record_size + data[offset + length_at] + (data[offset + length_at + 1] << 8)
+    if offset > size:
+        records.pop()
+    return records
+
+
+def _capture_fields( data, records, kinds ):
+    offsets = array('q')
+    timestamps = array('d')
+    directions = array('B')
+    session_start = 0.0
+    for offset in records:
+        timestamp, kind, length = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        if kind == SESSION:
+            session_start = _WALL_CLOCK.unpack_from(data, start)[0]
+        elif kind in kinds and length >= HEADER_SIZE:
+            offsets.append(start)
+            timestamps.append(session_start + timestamp)
+            directions.append(kind)
+    return offsets, timestamps, directions
+
+
+def _numpy_capture_fields( data, records, kinds ):
+    records = np.frombuffer(records, dtype=np.int64) if len(records) else np.zeros(0, dtype=np.int64)
+    fields = np.frombuffer(data, dtype=np.uint8)[records[:, None] + np.arange(_RECORD.size)].view(
+        np.dtype([('timestamp', '<f8'), ('kind', 'u1'), ('length', '<u2')]))[:, 0]
+    sessions = np.flatnonzero(fields['kind'] == SESSION)
+    session_starts = np.array([_WALL_CLOCK.unpack_from(data, records[i] + _RECORD.size)[0] for i in sessions])
+    # the session each record belongs to, and 0.0 for records before the first session record
+    session = np.searchsorted(sessions, np.arange(len(records)), side='right') - 1
+    starts = np.where(session >= 0, np.append(session_starts, 0.0)[session], 0.0)
+    wanted = np.isin(fields['kind'], [kind for kind in kinds if kind != SESSION]) & \
+        (fields['length'] >= HEADER_SIZE)
+    return (records[wanted] + _RECORD.size, (starts + fields['timestamp'])[wanted],
+            fields['kind'][wanted])
+
+
+## Offsets of the telegrams in a buffer, and the number of bytes skipped
+#
+#   This walk is the one part that cannot be done for all telegrams at once, as every telegram's offset depends on
+#   the length of the one before it. It is kept to a few local operations per telegram.
+#
+def _frame( buffer ):
+    offsets = array('q')
+    append = offsets.append
+    size = len(buffer)
+    end = size - HEADER_SIZE
+    soh = SOH
+    header_size = HEADER_SIZE
+    offset = 0
+    discarded = 0
+    while offset <= end:
+        if buffer[offset] == soh:
+            following = offset + header_size + buffer[offset + 2]
+            if following > size:
+                break
+            append(offset)
+            offset = following
+        else:
+            offset += 1
+            discarded += 1
+    return offsets, discarded + size - offset
+
+
+def _columns( buffer, offsets, timestamps, directions, discarded=0 ):
+    if np is not None:
+        return _numpy_columns(buffer, offsets, timestamps, directions, discarded)
+
+    types = array('B')
+    mlns = array('h')
+    commands = array('h')
+    sources = array('h')
+    volumes = array('h')
+    mln_at, command_at, source_at, volume_at = _MLN_AT, _COMMAND_AT, _SOURCE_AT, _VOLUME_AT
+    header_size = HEADER_SIZE
+    none = NONE
+    for offset in offsets:
+        msg_type = buffer[offset + 1]
+        size = header_size + buffer[offset + 2]
+        types.append(msg_type)
+        at = mln_at[msg_type]
+        mlns.append(buffer[offset + at] if 0 < at < size else none)
+        at = command_at[msg_type]
+        if 0 < at < size:
+            commands.append(buffer[offset + at])
+        else:
+            commands.append(_PRESS if msg_type == _VIRTUAL_BUTTON else none)
+        at = source_at[msg_type]
+        sources.append(buffer[offset + at] if 0 < at < size else none)
+        at = volume_at[msg_type]
+        volumes.append(buffer[offset + at] if 0 < at < size else none)
+    return TelegramColumns(array('d', timestamps), array('B', directions), types, mlns, commands, sources, volumes,
+                           discarded=discarded)
+
+
+def _numpy_columns( buffer, offsets, timestamps, directions, discarded ):
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    records = np.empty(len(offsets), dtype=_DTYPE)
+    records['timestamp'] = timestamps
+    records['direction'] = directions
+    types = data[offsets + 1]
+    records['type'] = types
+    sizes = HEADER_SIZE + data[offsets + 2].astype(np.int64)
+    for name, positions in (('mln', _MLN_AT), ('command', _COMMAND_AT), ('source', _SOURCE_AT),
+                            ('volume', _VOLUME_AT)):
+        at = np.array(positions, dtype=np.int64)[types]
+        present = (at > 0) & (at < sizes)
+        records[name] = np.where(present, data[np.where(present, offsets + at, 0)].astype(np.int16), NONE)
+    # older gateways send the virtual button number only, which is a press
+    records['command'][(types == _VIRTUAL_BUTTON) & (sizes == HEADER_SIZE + 1)] = _PRESS
+    return TelegramColumns(records['timestamp'], records['direction'], records['type'], records['mln'],
+                           records['command'], records['source'], records['volume'], records, discarded)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Count the telegrams of a capture by type")
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    columns = decode_capture(args.path)
+    elapsed = time.perf_counter() - start
+    for name, count in sorted(columns.type_counts().items(), key=lambda item: -item[1]):
+        print("%8d %s" % (count, name))
+    print("%d telegrams decoded in %.3f s%s" % (len(columns), elapsed, "" if np is not None else " (without NumPy)"))
@@ -0,0 +1,169 @@
+"""
+Binary capture of the telegrams exchanged with a Masterlink Gateway, and replay of a capture.
+
+A capture file starts with MAGIC, followed by records of
+
+    timestamp   float64, seconds since the start of the session (monotonic clock)
+    kind        uint8, RECEIVED, SENT or SESSION
+    length      uint16
+    data        the raw telegram, or for SESSION the wall clock start time as a float64
+
+All little endian. Every time a capture is opened a SESSION record is appended, so one file can hold the traffic of
+several Home Assistant runs. Dump a capture from the repository root with
+
+    python -m bangolufsen.capture capture.bin
+
+"""
+import argparse
+import asyncio
+import logging
+import struct
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+from .mlgw import TelegramStr, _getpayloadtypestr
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"MLGWCAP\x01"
+RECEIVED = 0
+SENT = 1
+SESSION = 2
+# Records waiting for the writer thread. Records beyond this are dropped, rather than slowing down the event loop.
+CAPTURE_QUEUE_SIZE = 4096
+
+_RECORD = struct.Struct("<dBH")
+_WALL_CLOCK = struct.Struct("<d")
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    kind: int
+    data: bytes
+
+
+"""
+CaptureWriter appends telegrams to a capture file from a background thread.
+
+write() only copies the telegram into a bounded queue, so it is cheap enough to call for every telegram on the event
+loop. The thread writes whatever has been queued in one go. If the disk cannot keep up, records are dropped and
+counted in `dropped`.
+
+"""
+class CaptureWriter:
+    def __init__(self, path, queue_size=CAPTURE_QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0
+        self.written = 0
+        self._queue_size = queue_size
+        self._records = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._start = time.monotonic()
+        self._records.append(_RECORD.pack(0.0, SESSION, _WALL_CLOCK.size) + _WALL_CLOCK.pack(time.time()))
+        self._thread = threading.Thread(target=self._run, name="mlgw-capture", daemon=True)
+        self._thread.start()
+
+    ## Queue a telegram (bytes or a memoryview, copied here) of the given kind
+    def write(self, kind, telegram):
+        record = _RECORD.pack(time.monotonic() - self._start, kind, len(telegram)) + telegram
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._records) >= self._queue_size:
+                self.dropped += 1
+                return
+            self._records.append(record)
+            self._condition.notify()
+
+    ## Stop accepting records. The thread writes what is queued and closes the file.
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        try:
+            with open(self.path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(MAGIC)
+                while True:
+                    with self._condition:
+                        while not self._records and not self._closed:
+                            self._condition.wait()
+                        records, self._records = self._records, deque()
+                        closed = self._closed
+                    if records:
+                        f.write(b''.join(records))
+                        f.flush()
+                        self.written += len(records)
+                    if closed:
+                        break
+        except OSError as e:
+            _LOGGER.error("Telegram capture to %s failed: %s", self.path, e)
+            with self._condition:
+                self._closed = True
+                self._records.clear()
+
+
+## Read the records of a capture file
+def read_capture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a telegram capture" % path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return  # end of file, or a record cut short by a crash
+            timestamp, kind, length = _RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield CaptureRecord(timestamp, kind, data)
+
+
+## Feed the received telegrams of a capture to receive(telegram), e.g. MLGateway._telegram_received.
+#
+#   speed 1 replays at the recorded speed, 2 twice as fast, and so on. With speed 0 the telegrams are fed as fast as
+#   possible, yielding to the event loop every batch telegrams so that callbacks scheduled by receive() still run.
+#   Returns the number of telegrams replayed.
+#
+async def replay(path, receive, speed=1.0, batch=100):
+    loop = asyncio.get_running_loop()
+    count = 0
+    session_start = None
+    for record in read_capture(path):
+        if record.kind == SESSION:
+            # timestamps start again at 0
+            session_start = None
+            continue
+        if record.kind != RECEIVED:
+            continue
+        if speed > 0:
+            if session_start is None:
+                session_start = loop.time() - record.timestamp / speed
+            delay = session_start + record.timestamp / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % batch == 0:
+            await asyncio.sleep(0)
+        receive(memoryview(record.data))
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a Masterlink Gateway telegram capture")
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    directions = {RECEIVED: '<', SENT: '>'}
+    for record in read_capture(args.path):
+        if record.kind == SESSION:
+            started = _WALL_CLOCK.unpack(record.data)[0]
+            print("--- session started %s" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)))
+            continue
+        print("%12.6f %s %s: %s" % (record.timestamp, directions.get(record.kind, '?'),
+                                    _getpayloadtypestr(record.data[1]), TelegramStr(record.data)))
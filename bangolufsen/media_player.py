@@ -29,6 +29,7 @@ media_player:
   password: usr00
   port: 9000
   default_source: A.MEM
+  send_delay: 50
   available_sources:
     - A.MEM
     - CD
@@ -43,13 +44,33 @@ media_player:
     - Bathroom
 
 Devices need to be defined in the same order as the MLGW configuration, and MLNs need to be sequential, starting from 1 for the first one.
+A device can also be given with its MLN, as `- name: Patio` and `mln: 3`.
+
+Several gateways are configured as a list. Username, password, port, send_delay, heartbeat_interval and heartbeat_timeout
+default to the values given for the platform. All the gateway connections share the Home Assistant event loop.
+
+media_player:
+  platform: bangolufsen
+  username: usr00
+  password: usr00
+  gateways:
+    - host: 192.168.1.10
+      devices:
+        - BeoSound
+        - Patio
+    - host: 192.168.1.11
+      devices:
+        - name: Kitchen
+          mln: 2
 
 """
+import asyncio
 import logging
-import voluptuous as vol
+import random
 import socket
-import time
-import threading
+from collections import Counter, deque
+from typing import FrozenSet, NamedTuple, Optional
+import voluptuous as vol
 
 #from homeassistant.components.media_player import (SUPPORT_TURN_OFF, SUPPORT_TURN_ON, 
 #                                                   PLATFORM_SCHEMA, MediaPlayerDevice, 
@@ -58,21 +79,59 @@ import threading
 from homeassistant.const import (CONF_HOST, CONF_NAME, CONF_USERNAME, 
                                  CONF_PASSWORD, CONF_PORT, STATE_OFF,
                                  STATE_ON, STATE_UNKNOWN, CONF_DEVICES,
-                                 EVENT_HOMEASSISTANT_STOP)
+                                 EVENT_HOMEASSISTANT_STOP, ATTR_ENTITY_ID,
+                                 ENTITY_MATCH_ALL)
+from homeassistant.core import callback
 
 from homeassistant.components.media_player import (
     MediaPlayerEntity,
     PLATFORM_SCHEMA)
 
 from homeassistant.components.media_player.const import (
+    ATTR_INPUT_SOURCE,
     SUPPORT_TURN_ON,
     SUPPORT_TURN_OFF,
     SUPPORT_SELECT_SOURCE,
     SUPPORT_VOLUME_STEP,
-    SUPPORT_VOLUME_MUTE
+    SUPPORT_VOLUME_MUTE,
+    SUPPORT_VOLUME_SET
 )
 
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.discovery import async_load_platform
+from homeassistant.helpers.storage import Store
+
+from . import DATA_GATEWAYS, DATA_IDENTITIES, DATA_STORE, DOMAIN
+from .capture import RECEIVED as CAPTURE_RECEIVED, SENT as CAPTURE_SENT, CaptureWriter
+from .metrics import GatewayMetrics
+from .subscriptions import get_subscriptions
+from .mlgw import (
+    BEO4_CMDS,
+    HEADER_SIZE,
+    PING_TELEGRAM,
+    SERIAL_REQUEST_TELEGRAM,
+    TelegramFramer,
+    TelegramStr,
+    UnknownTelegram,
+    _getbeo4commandstr,
+    _getdictstr,
+    _getpayloadtypestr,
+    _getroomstr,
+    _getselectedsourcestr,
+    _getvirtualactionstr,
+    decode,
+    encode_batch,
+    encode_beo4_cmd,
+    encode_login,
+    encode_telegram,
+    encode_virtual_btn_press,
+    iter_telegrams,
+    lctypedict,
+    loginstatusdict,
+    reverse_destselectordict,
+    reverse_selectedsourcedict,
+    speakermodedict,
+)
 
 _LOGGER = logging.getLogger(__name__)
 # _LOGGER.setLevel(logging.ERROR)
@@ -83,46 +142,267 @@ DEFAULT_SOURCE = 'A.MEM'
 AVAILABLE_SOURCES = ['CD', 'RADIO', 'A.MEM'] 
 CONF_DEFAULT_SOURCE = 'default_source'
 CONF_AVAILABLE_SOURCES = 'available_sources'
-SUPPORT_BEO = SUPPORT_TURN_ON | SUPPORT_TURN_OFF | SUPPORT_VOLUME_STEP | SUPPORT_SELECT_SOURCE | SUPPORT_VOLUME_MUTE 
+# Volume reported in Picture & Sound Status telegrams runs from 0 to MAX_VOLUME
+MAX_VOLUME = 90
+# Source Status activity of a product in standby
+SOURCE_STANDBY = 0x06
+ATTR_SPEAKER_MODE = 'speaker_mode'
+ATTR_CINEMA_MODE = 'cinema_mode'
+ATTR_STEREO = 'stereo'
+# Seconds between the volume steps of a burst. A step is a single small telegram, so they go closer together than
+# send_delay.
+VOLUME_STEP_GAP = 0.02
+# After a volume burst, seconds without a new Picture & Sound Status before the volume is checked against the target
+VOLUME_SETTLE = 0.3
+# Correction bursts sent when the volume did not end up on the target
+VOLUME_CORRECTIONS = 2
+# Heartbeat: ping the gateway when nothing has been received for heartbeat_interval seconds, and close the connection
+# when nothing arrives within heartbeat_timeout seconds of the ping
+CONF_HEARTBEAT_INTERVAL = 'heartbeat_interval'
+DEFAULT_HEARTBEAT_INTERVAL = 15
+CONF_HEARTBEAT_TIMEOUT = 'heartbeat_timeout'
+DEFAULT_HEARTBEAT_TIMEOUT = 5
+# TCP keepalive: probe after this many idle seconds, this many seconds apart, and give up after this many probes.
+# Data written and not acknowledged is given up on after the same time.
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+# Seconds to wait for the gateway to accept a connection
+CONNECT_TIMEOUT = 10
+# Minimum gap between telegrams sent to the gateway, in milliseconds
+CONF_SEND_DELAY = 'send_delay'
+DEFAULT_SEND_DELAY = 50
+# Requests the gateway replies to, and the type of the reply
+ACK_TYPES = {0x30: 0x31, 0x36: 0x37, 0x39: 0x3a}
+# Seconds to wait for an acknowledgement before sending the next telegram anyway
+ACK_TIMEOUT = 2
+# Seconds to wait for the reply to a request
+REQUEST_TIMEOUT = 5
+# Handshake states (see MLGateway._start_handshake)
+HANDSHAKE_DISCONNECTED = 'disconnected'
+HANDSHAKE_LOGIN = 'login'
+HANDSHAKE_READY = 'ready'
+HANDSHAKE_FAILED = 'failed'
+# Seconds to wait for the outcome of a login
+LOGIN_TIMEOUT = 3
+# The gateway serial numbers and device lists are kept here, so entities get their unique ids before connecting
+STORAGE_KEY = DOMAIN + '.gateways'
+STORAGE_VERSION = 1
+# Reconnect delay in seconds. It doubles after every failed attempt, up to the maximum.
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+# Collapse the stream of repeats sent while a Beo4 button is held into press, hold-start and release events
+CONF_COALESCE_HOLD = 'coalesce_hold'
+# Light/Control repeats more than this many seconds apart are separate presses
+HOLD_REPEAT_WINDOW = 0.5
+EVENT_VIRTUAL_BUTTON = 'bangolufsen_virtual_button'
+EVENT_LIGHT_CONTROL = 'bangolufsen_light_control_event'
+# Commands are buffered while the connection is down, and replayed once it is back
+COMMAND_BUFFER_SIZE = 32
+# Seconds after which a buffered command is too old to replay
+COMMAND_MAX_AGE = 30
+# Most commands queued for one MLN. Power and mute commands are always accepted.
+COMMAND_MLN_LIMIT = 8
+# Beo4 command classes. Queued commands are sent power and mute first, then source selections and other commands,
+# then volume steps.
+CMD_POWER = 0
+CMD_SOURCE = 1
+CMD_OTHER = 2
+CMD_VOLUME = 3
+COMMAND_PRIORITY = {CMD_POWER: 0, CMD_SOURCE: 1, CMD_OTHER: 1, CMD_VOLUME: 2}
+COMMAND_CLASSES = dict(
+    [(BEO4_CMDS[name], CMD_POWER) for name in ('STANDBY', 'SLEEP', 'MUTE')] +
+    [(BEO4_CMDS[name], CMD_SOURCE) for name in ('TV', 'RADIO', 'DTV2', 'AUX_A', 'V.MEM', 'DVD', 'CAMERA', 'TEXT',
+                                                'DTV', 'PC', 'A.MEM', 'CD', 'N.RADIO', 'N.MUSIC', 'CD2')] +
+    [(BEO4_CMDS[name], CMD_VOLUME) for name in ('VOLUME UP', 'VOLUME DOWN')]
+)
+# Telegrams received but not processed yet. The queue holds a full receive buffer of the shortest telegrams. When it
+# is full, reading from the gateway is paused until it is down to INGEST_RESUME_AT, and the telegrams of the read in
+# progress are dropped or merged as INGEST_POLICY says.
+INGEST_QUEUE_SIZE = 1024
+INGEST_RESUME_AT = 256
+# Seconds spent processing telegrams per event loop iteration, so that reading from the gateway is not held up
+INGEST_TIME_BUDGET = 0.01
+INGEST_DROP = 0     # dropped when the queue is full
+INGEST_MERGE = 1    # replaces the queued telegram of the same type for the same MLN, full or not
+INGEST_KEEP = 2     # queued even when the queue is full
+# Policy by message type, INGEST_DROP for the others. A virtual button RELEASE is always kept, so that no button is
+# left held.
+INGEST_POLICY = {
+    0x02: INGEST_MERGE,     # Source Status
+    0x03: INGEST_MERGE,     # Pict&Snd Status
+    0x05: INGEST_KEEP,      # All standby
+    0x31: INGEST_KEEP,      # Login status
+    0x37: INGEST_KEEP,      # Pong
+    0x3a: INGEST_KEEP,      # Serial Number
+}
+# Append every telegram sent and received to this file, for offline replay (see capture.py)
+CONF_CAPTURE_FILE = 'capture_file'
+CONF_GATEWAYS = 'gateways'
+# Services acting on several devices at once, with as few telegrams as possible
+SERVICE_STANDBY = 'standby'
+SERVICE_SELECT_SOURCE = 'select_source'
+CONF_MLN = 'mln'
+# Gateway settings that default to the platform settings
+GATEWAY_INHERITED = (CONF_USERNAME, CONF_PASSWORD, CONF_PORT, CONF_SEND_DELAY, CONF_HEARTBEAT_INTERVAL,
+                     CONF_HEARTBEAT_TIMEOUT)
+SUPPORT_BEO = SUPPORT_TURN_ON | SUPPORT_TURN_OFF | SUPPORT_VOLUME_STEP | SUPPORT_SELECT_SOURCE | SUPPORT_VOLUME_MUTE | SUPPORT_VOLUME_SET
+
+DEVICE_SCHEMA = vol.Any(cv.string, vol.Schema({
+    vol.Required(CONF_NAME): cv.string,
+    vol.Optional(CONF_MLN): vol.All(vol.Coerce(int), vol.Range(min=1, max=255)),
+}))
+
+GATEWAY_SCHEMA = vol.Schema({
+    vol.Required(CONF_HOST): cv.string,
+    vol.Required(CONF_DEVICES): vol.All(cv.ensure_list, [DEVICE_SCHEMA]),
+    vol.Optional(CONF_USERNAME): cv.string,
+    vol.Optional(CONF_PASSWORD): cv.string,
+    vol.Optional(CONF_PORT): cv.positive_int,
+    vol.Optional(CONF_SEND_DELAY): cv.positive_int,
+    vol.Optional(CONF_CAPTURE_FILE): cv.string,
+    vol.Optional(CONF_HEARTBEAT_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_HEARTBEAT_TIMEOUT): cv.positive_int,
+})
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_HOST, default='192.168.1.10'): cv.string,
-    vol.Required(CONF_DEVICES): cv.ensure_list,
+    vol.Optional(CONF_DEVICES): vol.All(cv.ensure_list, [DEVICE_SCHEMA]),
+    vol.Optional(CONF_GATEWAYS): vol.All(cv.ensure_list, [GATEWAY_SCHEMA]),
     vol.Optional(CONF_USERNAME, default='admin'): cv.string,
     vol.Optional(CONF_PASSWORD, default='admin'): cv.string,
     vol.Optional(CONF_PORT, default=9000): cv.positive_int,
     vol.Optional(CONF_DEFAULT_SOURCE, default=DEFAULT_SOURCE): cv.string,
     vol.Optional(CONF_AVAILABLE_SOURCES, default=AVAILABLE_SOURCES): cv.ensure_list,
+    vol.Optional(CONF_SEND_DELAY, default=DEFAULT_SEND_DELAY): cv.positive_int,
+    vol.Optional(CONF_COALESCE_HOLD, default=False): cv.boolean,
+    vol.Optional(CONF_CAPTURE_FILE): cv.string,
+    vol.Optional(CONF_HEARTBEAT_INTERVAL, default=DEFAULT_HEARTBEAT_INTERVAL): cv.positive_int,
+    vol.Optional(CONF_HEARTBEAT_TIMEOUT, default=DEFAULT_HEARTBEAT_TIMEOUT): cv.positive_int,
+}), cv.has_at_least_one_key(CONF_DEVICES, CONF_GATEWAYS))
+
+GROUP_SERVICE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_ENTITY_ID): cv.comp_entity_ids,
 })
 
+SELECT_SOURCE_SERVICE_SCHEMA = GROUP_SERVICE_SCHEMA.extend({
+    vol.Required(ATTR_INPUT_SOURCE): cv.string,
+})
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
-    host = config.get(CONF_HOST)
-    username = config.get(CONF_USERNAME)
-    password = config.get(CONF_PASSWORD)
-    port = config.get(CONF_PORT)
-    devices = config.get(CONF_DEVICES)
-    default_source = config.get(CONF_DEFAULT_SOURCE)
-    available_sources = config.get(CONF_AVAILABLE_SOURCES)
-
-    gateway = MLGateway(host, port, username, password, default_source, available_sources, hass)
-    gateway.connect()
 
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    gateway_configs = list(config.get(CONF_GATEWAYS, []))
+    if CONF_DEVICES in config:
+        gateway_configs.insert(0, config)
+
+    data = hass.data.setdefault(DOMAIN, {})
+    data.setdefault(DATA_GATEWAYS, {})
+    if DATA_STORE not in data:
+        # a small local file, read once for all the gateways
+        data[DATA_STORE] = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+        data[DATA_IDENTITIES] = await data[DATA_STORE].async_load() or {}
+    gateways = []
+    for gateway_config in gateway_configs:
+        gateway_config = {**{key: config[key] for key in GATEWAY_INHERITED if key in config}, **gateway_config}
+        gateway = _setup_gateway(hass, config, gateway_config, data)
+        if gateway is not None:
+            gateways.append(gateway)
+
+    @callback
     def _stop_listener(_event):
-        gateway.stopped.set()
+        for gateway in gateways:
+            gateway.stop()
 
-    hass.bus.listen_once(
+    hass.bus.async_listen_once(
         EVENT_HOMEASSISTANT_STOP,
         _stop_listener
     )
 
-    if gateway.connected:
-        _LOGGER.info('Adding devices: ' + ', '.join(devices))
-        mp_devices = [BeoSpeaker(i + 1, device, gateway) for i, device in enumerate(devices)]
-        add_devices(mp_devices)
-        gateway.set_devices(mp_devices) # tell the gateway the list of devices connected to it.
-    else:
-        _LOGGER.error('Not connected')
+    if not hass.services.has_service(DOMAIN, SERVICE_STANDBY):
+        async def _async_group_service(call):
+            _async_group_service_call(hass, call)
+
+        hass.services.async_register(DOMAIN, SERVICE_STANDBY, _async_group_service, GROUP_SERVICE_SCHEMA)
+        hass.services.async_register(DOMAIN, SERVICE_SELECT_SOURCE, _async_group_service, SELECT_SOURCE_SERVICE_SCHEMA)
+
+    # Devices are added straight away. They are unavailable until their gateway is connected,
+    # and each gateway keeps reconnecting in the background if the connection fails or drops.
+    for gateway in gateways:
+        async_add_entities(gateway.devices)
+        gateway.start()
+        # the diagnostic sensors find the gateway in hass.data
+        hass.async_create_task(async_load_platform(hass, 'sensor', DOMAIN, {'gateway': gateway.gateway_id}, config))
+
+
+## Run a group service: every gateway gets one telegram, or one batch of telegrams, for the devices it serves
+def _async_group_service_call(hass, call):
+    entity_ids = call.data.get(ATTR_ENTITY_ID)
+    if entity_ids == ENTITY_MATCH_ALL:
+        entity_ids = None
+    elif entity_ids is not None:
+        entity_ids = set(entity_ids)
+    for gateway in hass.data[DOMAIN][DATA_GATEWAYS].values():
+        devices = None
+        if entity_ids is not None:
+            devices = [device for device in gateway.devices if device.entity_id in entity_ids]
+            if not devices:
+                continue
+        if call.service == SERVICE_STANDBY:
+            gateway.group_standby(devices)
+        else:
+            gateway.group_select_source(call.data[ATTR_INPUT_SOURCE], devices)
+
+
+## Create a gateway and its devices, and index the gateway in hass.data. Returns None if the gateway is already set up.
+def _setup_gateway(hass, config, gateway_config, data):
+    host = gateway_config[CONF_HOST]
+    port = gateway_config[CONF_PORT]
+    gateway_id = "%s:%d" % (host, port)
+    if gateway_id in data[DATA_GATEWAYS]:
+        _LOGGER.error("ML Gateway %s is configured more than once", gateway_id)
+        return None
+
+    capture_file = gateway_config.get(CONF_CAPTURE_FILE)
+    if capture_file is not None:
+        capture_file = hass.config.path(capture_file)
+    identities = data[DATA_IDENTITIES]
+    identity = identities.get(gateway_id, {})
+    gateway = MLGateway(host, port, gateway_config[CONF_USERNAME], gateway_config[CONF_PASSWORD],
+                        config[CONF_DEFAULT_SOURCE], config[CONF_AVAILABLE_SOURCES], hass, gateway_config[CONF_SEND_DELAY],
+                        config[CONF_COALESCE_HOLD], capture_file, identity.get('serial'),
+                        heartbeat_interval=gateway_config[CONF_HEARTBEAT_INTERVAL],
+                        heartbeat_timeout=gateway_config[CONF_HEARTBEAT_TIMEOUT])
+
+    # MLNs follow the order of the devices, unless given
+    mp_devices = []
+    mlns = set()
+    for i, device in enumerate(gateway_config[CONF_DEVICES]):
+        if isinstance(device, dict):
+            name, mln = device[CONF_NAME], device.get(CONF_MLN, i + 1)
+        else:
+            name, mln = device, i + 1
+        if mln in mlns:
+            _LOGGER.error("MLN %d of %s is used by another device on %s", mln, name, gateway_id)
+            continue
+        mlns.add(mln)
+        mp_devices.append(BeoSpeaker(mln, name, gateway))
+    _LOGGER.info('Adding devices on %s: %s', gateway_id, ', '.join(device.name for device in mp_devices))
+    gateway.set_devices(mp_devices) # tell the gateway the list of devices connected to it.
+
+    data[DATA_GATEWAYS][gateway_id] = gateway
+
+    # keep the serial number and the devices of the gateway for the next start
+    def _save_identity(gateway):
+        identities[gateway_id] = {
+            'serial': gateway.serial,
+            'devices': [[device.mln, device.name] for device in gateway.devices],
+        }
+        data[DATA_STORE].async_delay_save(lambda: identities, 1)
+
+    gateway.serial_listener = _save_identity
+    if identity.get('devices') != [[device.mln, device.name] for device in mp_devices]:
+        _save_identity(gateway)
+    return gateway
 
 """
 BeoSpeaker represents a single MasterLink device on the Masterlink bus. E.g., a speaker like BeoSound 3500 or a Masterlink Master device like a receiver or TV (e.g, a Beosound 3000)
@@ -136,7 +416,32 @@ class BeoSpeaker(MediaPlayerEntity):
         self._name = name
         self._gateway = gateway
         self._pwon = False
-        self._source = self._gateway.beolink_source
+        # Picture & Sound Status (0x03) values, pushed by the gateway
+        self._pictsnd = None
+        # set_volume_level in progress
+        self._volume_target = None
+        self._volume_corrections = 0
+        self._volume_check = None
+
+    @property
+    def should_poll(self):
+        # State is pushed by the gateway
+        return False
+
+    @property
+    def mln(self):
+        return self._mln
+
+    @property
+    def unique_id(self):
+        # the serial number is known from an earlier run, or once the gateway has sent it
+        if self._gateway.serial is None:
+            return None
+        return "%s_%d" % (self._gateway.serial, self._mln)
+
+    @property
+    def available(self):
+        return self._gateway.available
 
     @property
     def name(self):
@@ -159,8 +464,7 @@ class BeoSpeaker(MediaPlayerEntity):
     @property
     def source(self):
         # Name of the current input source. Because the source is common across all the speakers connected to the gateway, we just pass through the beolink.
-        self._source = self._gateway.beolink_source
-        return self._source
+        return self._gateway.beolink_source
 
     @property
     def source_list(self):
@@ -175,35 +479,140 @@ class BeoSpeaker(MediaPlayerEntity):
         else:
             return STATE_OFF
 
+    @property
+    def volume_level(self):
+        """Volume level reported by the device (0..1)."""
+        if self._pictsnd is None:
+            return None
+        return min(self._pictsnd.volume / MAX_VOLUME, 1.0)
+
+    @property
+    def is_volume_muted(self):
+        """Mute status reported by the device."""
+        if self._pictsnd is None:
+            return None
+        return self._pictsnd.sound_status == 0x01
+
+    @property
+    def extra_state_attributes(self):
+        if self._pictsnd is None:
+            return None
+        return {
+            ATTR_SPEAKER_MODE: _getdictstr(speakermodedict, self._pictsnd.speaker_mode),
+            ATTR_CINEMA_MODE: self._pictsnd.cinema_mode == 0x01,
+            ATTR_STEREO: self._pictsnd.stereo == 0x01,
+        }
+
     def set_state(self, _state):
 # to be called by the gateway to set the state to off when there is an event on the ml bus that turns off the device
+# returns True if the state changed
+        pwon = self._pwon
         if _state == STATE_ON:
             self._pwon = True
         elif _state == STATE_OFF:
             self._pwon = False
-
-    def turn_on(self):
-        self.select_source(self._gateway.beolink_source)
+            # a volume being set is not corrected on a device in standby
+            self._volume_done()
+        if self._pwon != pwon:
+            self._async_state_changed()
+            return True
+        return False
+
+    ## Called by the gateway with every Picture & Sound Status telegram for this device
+    def set_pictsnd_status(self, status):
+        if status != self._pictsnd:
+            self._pictsnd = status
+            self._async_state_changed()
+        if self._volume_target is not None:
+            if status.volume == self._volume_target:
+                self._volume_done()
+            elif self._volume_check is not None:
+                # the burst is still arriving
+                self._schedule_volume_check()
+
+    ## Write the new state to Home Assistant, once the entity has been added
+    def _async_state_changed(self):
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+    async def async_turn_on(self):
+        await self.async_select_source(self._gateway.beolink_source)
 # An alternate is to turn on with volume up which for most devices, turns it on without changing source, but it does nothing on the BeoSound system.
 #        self._pwon = True
-#        self.volume_up()
+#        await self.async_volume_up()
 
-    def turn_off(self):
-        self._pwon = False
+    async def async_turn_off(self):
+        self.set_state(STATE_OFF)
         self._gateway.send_beo4_cmd(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), BEO4_CMDS.get('STANDBY'))
 
-    def select_source(self, source):
-        self._pwon = True
-        self._source = source
-        self._gateway.send_beo4_cmd_source(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), self._source)
+    async def async_select_source(self, source):
+        if self._pwon and self._gateway.source_selected(self._mln, source):
+            _LOGGER.debug("%s is already on %s", self._name, source)
+            return
+        self.set_state(STATE_ON)
+        self._gateway.send_beo4_cmd_source(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), source)
+
+    ## Move the volume to the target in one burst of volume steps, worked out from the last reported volume.
+    #
+    #   Once the reported volume has settled, a different volume (a step lost, or the volume changed meanwhile) is
+    #   corrected with another burst.
+    #
+    async def async_set_volume_level(self, volume):
+        if self._pictsnd is None:
+            _LOGGER.warning("Volume of %s is not known yet", self._name)
+            return
+        self._volume_target = max(0, min(MAX_VOLUME, round(volume * MAX_VOLUME)))
+        self._volume_corrections = 0
+        self._send_volume_burst()
+
+    def _send_volume_burst(self):
+        steps = self._volume_target - self._pictsnd.volume
+        if steps == 0:
+            self._volume_done()
+            return
+        future = self._gateway.send_volume_steps(self._mln, steps)
+        future.add_done_callback(lambda _future: self._schedule_volume_check())
+
+    def _schedule_volume_check(self):
+        if self._volume_check is not None:
+            self._volume_check.cancel()
+            self._volume_check = None
+        if self._volume_target is not None:
+            self._volume_check = asyncio.get_running_loop().call_later(VOLUME_SETTLE, self._check_volume)
+
+    def _check_volume(self):
+        self._volume_check = None
+        if self._volume_target is None:
+            return
+        if self._pictsnd.volume == self._volume_target:
+            self._volume_done()
+        elif self._volume_corrections < VOLUME_CORRECTIONS:
+            self._volume_corrections += 1
+            self._send_volume_burst()
+        else:
+            _LOGGER.info("Volume of %s is %d, not %d", self._name, self._pictsnd.volume, self._volume_target)
+            self._volume_done()
 
-    def volume_up(self):
+    def _volume_done(self):
+        self._volume_target = None
+        if self._volume_check is not None:
+            self._volume_check.cancel()
+            self._volume_check = None
+
+    async def async_volume_up(self):
         self._gateway.send_beo4_cmd(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), BEO4_CMDS.get('VOLUME UP'))
 
-    def volume_down(self):
+    async def async_volume_down(self):
         self._gateway.send_beo4_cmd(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), BEO4_CMDS.get('VOLUME DOWN'))
 
-    def mute_volume(self, mute):
+    ## MUTE toggles, so it is only sent when the reported mute status is not the one asked for, or is not known
+    async def async_mute_volume(self, mute):
+        if self.is_volume_muted == mute:
+            _LOGGER.debug("%s is already %s", self._name, "muted" if mute else "unmuted")
+            self._gateway.commands_skipped += 1
+            return
+        # the volume steps still queued are dropped, and are not to be corrected
+        self._volume_done()
         self._gateway.send_beo4_cmd(self._mln, reverse_destselectordict.get('AUDIO SOURCE'), BEO4_CMDS.get('MUTE'))
 
 """
@@ -213,26 +622,68 @@ These integrations allow Home Assistant to control your legacy Bang & Olufsen Ma
 
 """
 class MLGateway:
-    def __init__(self, host, port, user, password, default_source, available_sources, hass):
+    def __init__(self, host, port, user, password, default_source, available_sources, hass, send_delay=DEFAULT_SEND_DELAY, coalesce_hold=False,
+                 capture_file=None, serial=None, ingest_policy=None,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT):
         self._host = host
+        self.gateway_id = "%s:%d" % (host, port)
         self._user = user
         self._password = password
         self._port = port
-        self._tcpip = host
-        self.buffersize = 1024
-        self._socket = None
+        self._transport = None
+        self._send_delay = send_delay / 1000
+        self._queue = _CommandScheduler()   # commands, sent once the gateway is ready
+        self._control = deque()     # ping, login and serial number requests, sent as soon as we are connected
+        self._queue_event = asyncio.Event()
+        self._ready = False
+        self._stopped = False
+        self._disconnected = asyncio.Event()
+        self._supervisor_task = None
+        self.reconnects = 0
+        self._writer_task = None
+        self._waiters = {}
+        self._ingest = _IngestQueue(policy=ingest_policy)
+        self._ingest_handle = None
+        self._reading_paused = False
+        self.reading_pauses = 0
+        # handlers for unsolicited telegrams, by message type. Each is passed the decoded message.
+        self._handlers = {
+            0x02: self._on_source_status,
+            0x03: self._on_pictsnd_status,
+            0x04: self._on_light_control,
+            0x05: self._on_all_standby,
+            0x20: self._on_virtual_button,
+            0x31: self._on_login_status,
+            0x37: self._on_pong,
+            0x3a: self._on_serial_number,
+        }
+        self.handshake_state = HANDSHAKE_DISCONNECTED
+        self._handshake_timer = None
+        self._login_failures = 0
+        self._pong_received = False
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+        self._heartbeat_handle = None
+        self._heartbeat_sent = None     # time of the heartbeat ping waiting for an answer
+        self.heartbeat_failures = 0
+        self._responsive = False        # the gateway has answered on this connection
+        self._last_rx = 0
         self.connected = False
         self.telegramlogging = True
-        self.stopped = threading.Event()
-        self._sourceMLN = 1 
         self._source = default_source
-        self._sourceMediumPosition = 0xffff
-        self._sourcePosition = 0x00ff
-        self._sourceActivity = None
-        self._pictureFormat = None
+        # last Source Status of each MLN, as long as no power or source command has been sent to it since
+        self._source_status = {}
+        self.commands_skipped = 0
         self._available_sources = available_sources
         self._devices = None
+        self._devices_by_mln = {}
+        self._serial = serial       # cached from an earlier run until the gateway tells us
+        self.serial_listener = None # called when the gateway reports a different serial number
         self._hass = hass
+        self._events = _EventDispatcher(hass, coalesce_hold, get_subscriptions(hass) if hass is not None else None)
+        self.metrics = GatewayMetrics()
+        self._capture_file = capture_file
+        self._capture = None
 
     ## Return last selected source or last source status received from mlgw
     @property
@@ -243,437 +694,999 @@ class MLGateway:
     def available_sources(self):
         return self._available_sources
 
+    @property
+    def devices(self):
+        return self._devices or []
+
+    @property
+    def serial(self):
+        return self._serial
+
+    ## Connected, and the gateway has answered the handshake. The heartbeat closes the connection when the gateway
+    ## stops answering.
+    @property
+    def available(self):
+        return self.connected and self._responsive
+
+    ## Number of events fired, and HOLD repeats suppressed, in the last complete second
+    @property
+    def events_per_second(self):
+        return self._events.events_per_second
+
+    ## Traffic counters and latencies (see GatewayMetrics), and the state of the connection and the send queues
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        snapshot['connected'] = self.connected
+        snapshot['reconnects'] = self.reconnects
+        snapshot['heartbeat_failures'] = self.heartbeat_failures
+        snapshot['queue_depth'] = len(self._queue)
+        snapshot['commands_dropped'] = self._queue.dropped
+        snapshot['commands_skipped'] = self.commands_skipped
+        snapshot['control_queue_depth'] = len(self._control)
+        snapshot['ingest_queue_depth'] = len(self._ingest)
+        snapshot['ingest_merged'] = self._ingest.merged
+        snapshot['ingest_dropped'] = sum(self._ingest.dropped.values())
+        snapshot['ingest_dropped_by_type'] = {_getpayloadtypestr(msg_type): count
+                                              for msg_type, count in self._ingest.dropped.items()}
+        snapshot['reading_pauses'] = self.reading_pauses
+        snapshot['events_per_second'] = dict(self.events_per_second)
+        return snapshot
+
 # populate the list of devices configured on the gateway.
     def set_devices(self, devices):
         self._devices = devices
+        self._devices_by_mln = {device.mln: device for device in devices}
+
+    ## Start the connection supervisor, which connects to mlgw and reconnects whenever the connection is lost
+    def start(self):
+        self._stopped = False
+        if self._capture_file is not None and self._capture is None:
+            self._capture = CaptureWriter(self._capture_file)
+        self._supervisor_task = asyncio.get_running_loop().create_task(self._async_supervise())
+
+    ## Stop reconnecting, close the connection and drop all buffered commands
+    def stop(self):
+        self._stopped = True
+        self._disconnected.set()
+        self.close()
+        self._queue.cancel_all()
+        if self._capture is not None:
+            self._capture.close()
+            if self._capture.dropped:
+                _LOGGER.warning("Telegram capture dropped %d telegrams", self._capture.dropped)
+            self._capture = None
+
+    async def _async_supervise(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._stopped:
+            self._disconnected.clear()
+            if await self.async_connect():
+                await self._disconnected.wait()
+                if self._stopped:
+                    self.close()
+                    break
+                self.reconnects += 1
+                if self.handshake_state == HANDSHAKE_FAILED:
+                    # the login was refused: keep trying, in case the credentials are changed on the gateway
+                    delay = RECONNECT_MAX_DELAY
+                elif self._responsive:
+                    # try again straight away: the gateway may just have dropped the connection
+                    delay = RECONNECT_MIN_DELAY
+                    continue
+                # otherwise the connection was accepted, but the gateway never answered: back off as if it had been
+                # refused
+
+            if self._stopped:
+                break
+            # jittered exponential backoff, so a rebooting gateway is not hammered
+            wait = delay / 2 + random.uniform(0, delay / 2)
+            _LOGGER.info("Reconnecting to ML Gateway in %.1f s", wait)
+            self._disconnected.clear()
+            try:
+                await asyncio.wait_for(self._disconnected.wait(), wait)  # set by stop()
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
-    ## Open tcp connection to mlgw
-    def connect(self):
+    ## Open tcp connection to mlgw. Returns True if connected.
+    async def async_connect(self):
         _LOGGER.info('Trying to connect')
         self.connected = False
+        self._responsive = False
 
-        # get ip address for hostname
-        if self._tcpip is None:
-          try:
-              self._tcpip = socket.gethostbyname(self._host)
-          except Exception as e:
-              _LOGGER.error("Error resolving '%s': %s" % (self._host, e))
-              return
-
-        # open socket to masterlink gateway
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(600)
+        # open connection to masterlink gateway on the event loop
+        loop = asyncio.get_running_loop()
         try:
-             self._socket.connect((self._tcpip, self._port))
-             threading.Thread(target=self._listen).start()
-        except Exception as e:
-            self._socket = None
-            _LOGGER.error("Error opening connection to %s: %s" % (self._tcpip, e))
+            transport, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: _MLGWProtocol(self), self._host, self._port), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._transport = None
+            _LOGGER.error("Error opening connection to %s: %r" % (self._host, e))
+            return False
+        _set_keepalive(transport.get_extra_info('socket'))
+
+        _LOGGER.info("Opened connection to ML Gateway on " + self._host + ":" + str(self._port))
+        self.connected = True
+        self._last_rx = loop.time()
+        self._heartbeat_sent = None
+        self._heartbeat_handle = loop.call_later(self._heartbeat_interval, self._heartbeat)
+        self._writer_task = loop.create_task(self._async_writer(self._transport))
+        self._async_availability_changed()
+        self._start_handshake(ping=True)
+        return True
+
+    ## Handshake state machine.
+    #
+    #   The login request, a ping and the serial number request go out in a single write straight after connecting,
+    #   without waiting for the gateway to ask for a login. The replies drive the state from there:
+    #
+    #   LOGIN   -> READY   on Login status OK
+    #           -> FAILED  on a second Login status FAIL: the gateway may greet a new connection with a FAIL, so only
+    #                      the second one is the reply to our login. The connection is closed, and the supervisor
+    #                      retries after RECONNECT_MAX_DELAY.
+    #           -> READY   on LOGIN_TIMEOUT with a pong but no login status: the gateway does not ask for a login
+    #           (closed)   on LOGIN_TIMEOUT otherwise, e.g. a FAIL greeting and the reply to our login lost or late;
+    #                      the supervisor reconnects with backoff
+    #   READY   -> LOGIN   on Login status FAIL: the gateway wants a new login, which is sent on its own
+    #
+    def _start_handshake(self, ping=False):
+        self.handshake_state = HANDSHAKE_LOGIN
+        self._login_failures = 0
+        self._pong_received = False
+        self._ready = False
+        login = encode_login(self._user, self._password)
+        telegrams = [login, PING_TELEGRAM, SERIAL_REQUEST_TELEGRAM] if ping else [login]
+        loop = asyncio.get_running_loop()
+        self._control.append(_Command(encode_batch(telegrams), None, loop.create_future(), loop.time()))
+        self._queue_event.set()
+        self._cancel_handshake_timer()
+        self._handshake_timer = loop.call_later(LOGIN_TIMEOUT, self._handshake_timeout)
+
+    def _handshake_timeout(self):
+        self._handshake_timer = None
+        if self.handshake_state != HANDSHAKE_LOGIN:
             return
-
-        if self._tcpip != self._host:
-            _LOGGER.info("Opened connection to ML Gateway '" + self._host + "' on IP " + self._tcpip + ":" + str(self._port))
+        if self._pong_received and not self._login_failures:
+            _LOGGER.info('ML Gateway did not ask for a login')
+            self._handshake_done()
         else:
-            _LOGGER.info("Opened connection to ML Gateway on IP " + self._tcpip + ":" + str(self._port))
-        self.connected = True
-        self.ping()
+            _LOGGER.error('No login reply from ML Gateway')
+            self.close()
+
+    def _handshake_done(self):
+        self._cancel_handshake_timer()
+        self.handshake_state = HANDSHAKE_READY
+        self._set_ready()
+        if not self._responsive:
+            self._responsive = True
+            self._async_availability_changed()
+
+    def _login_failed(self):
+        _LOGGER.error('Login failed, check username and password')
+        self.close()
+        self.handshake_state = HANDSHAKE_FAILED     # until the next connection
+
+    def _cancel_handshake_timer(self):
+        if self._handshake_timer is not None:
+            self._handshake_timer.cancel()
+            self._handshake_timer = None
+
+    ## The gateway accepts commands: start sending the buffered ones
+    def _set_ready(self):
+        if self.connected and not self._ready:
+            self._ready = True
+            self._queue_event.set()
+
+    def _async_availability_changed(self):
+        if self._devices is not None:
+            for i in self._devices:
+                i._async_state_changed()
 
     ## Login
-    def login(self):
-        _LOGGER.info('Trying to login')
-        if self.connected:
-            wrkstr = self._user + chr(0x00) + self._password
-            payload = bytearray()
-            for c in wrkstr:
-                payload.append(ord(c))
-            self.send(0x30, payload)   # login Request
-
     def ping(self):
         _LOGGER.info('ping')
-        self.send(0x36, '')
-
-    ## Close connection to mlgw
+        return self.send_telegram(PING_TELEGRAM)
+
+    ## Ping mlgw and wait for the pong. Returns the round trip time in seconds.
+    async def async_ping(self):
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        await self.async_request(PING_TELEGRAM)
+        return loop.time() - sent
+
+    ## Send a request and wait for its reply.
+    #
+    #   The reply is matched by its type (see ACK_TYPES), in the order the requests were written.
+    #   Only the listener reads from the connection.
+    #   Raises asyncio.TimeoutError if no reply arrives within timeout, or within REQUEST_TIMEOUT of the
+    #   request being written, and ConnectionError if the request could not be sent.
+    #
+    async def async_request(self, telegram, timeout=REQUEST_TIMEOUT):
+        future = self.send_telegram(telegram)
+        try:
+            done, _ = await asyncio.wait((future,), timeout=timeout)
+        finally:
+            if not future.done():
+                future.cancel()
+        if not done or future.cancelled() and self.connected:
+            raise asyncio.TimeoutError("No reply to %s" % _getpayloadtypestr(telegram[1]))
+        if future.cancelled():
+            raise ConnectionError("Not connected to ML Gateway")
+        return future.result()
+
+    ## Close connection to mlgw. Buffered commands are kept for the next connection.
     def close(self):
         if self.connected:
             self.connected = False
-            self.stopped.set()
-            self._socket.shutdown(socket.SHUT_RDWR)
-            self._socket.close()
+            self._ready = False
+            if self._heartbeat_handle is not None:
+                self._heartbeat_handle.cancel()
+                self._heartbeat_handle = None
+            # wake up the writer so it can exit, and drop the requests for this connection
+            self._queue_event.set()
+            while self._control:
+                self._control.popleft().future.cancel()
+            for waiters in self._waiters.values():
+                for future in waiters:
+                    future.cancel()
+            self._waiters.clear()
+            self.metrics.reset_pending()
+            self._cancel_handshake_timer()
+            self.handshake_state = HANDSHAKE_DISCONNECTED
+            self._reading_paused = False
+            self._transport.close()
             _LOGGER.info("Closed connection to ML Gateway")
-
-    ## Send command to mlgw
+            self._async_availability_changed()
+        self._disconnected.set()
+
+    ## Queue a command for mlgw.
+    #
+    #   Returns immediately with a future, which is resolved once the telegram has been
+    #   written (or, for requests the gateway replies to, with a copy of the reply telegram).
+    #   The future is cancelled if the telegram can not be sent. Must be called from the event loop.
+    #
+    #   Commands sent while the connection is down are buffered (up to COMMAND_BUFFER_SIZE, oldest
+    #   dropped first) and replayed after reconnecting, unless they are older than COMMAND_MAX_AGE.
+    #
     def send(self, msg_type, payload):
-        if self.connected:
-            self._telegram = bytearray()
-            self._telegram.append(0x01)             # byte[0] SOH
-            self._telegram.append(msg_type)         # byte[1] msg_type
-            self._telegram.append(len(payload))     # byte[2] Length
-            self._telegram.append(0x00)             # byte[3] Spare
-            for p in payload:
-                self._telegram.append(p)
-            self._socket.sendall(self._telegram)
-
-            # Sleep to allow msg to arrive
-            time.sleep(1)
-
-            if self.telegramlogging:
-                _LOGGER.info("mlgw: >SENT: " + _getpayloadtypestr(msg_type) + ": " + _getpayloadstr(self._telegram))  # debug
+        return self.send_telegram(encode_telegram(msg_type, payload))
+
+    ## Queue a telegram built by one of the mlgw encoders
+    def send_telegram(self, telegram):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        command = _Command(telegram, ACK_TYPES.get(telegram[1]), future, loop.time())
+        if command.reply_type is not None:
+            # requests only make sense on the current connection
+            if not self.connected:
+                future.cancel()
+                return future
+            self._control.append(command)
+        else:
+            if self._stopped:
+                future.cancel()
+                return future
+            self._queue.push(command)
+        self._queue_event.set()
+        return future
+
+    ## Single writer for the connection. Sends queued telegrams no closer than send_delay apart, and the steps of a
+    ## volume burst VOLUME_STEP_GAP apart.
+    async def _async_writer(self, transport):
+        loop = asyncio.get_running_loop()
+        sent_at = None
+        burst = None    # seq of the volume burst being written
+        while self.connected and self._transport is transport:
+            if self._control:
+                command = self._control[0]
+            elif self._queue and self._ready:
+                command = self._queue.peek()
+            else:
+                self._queue_event.clear()
+                await self._queue_event.wait()
+                continue
+            if sent_at is not None:
+                gap = VOLUME_STEP_GAP if burst is not None and command.seq == burst else self._send_delay
+                delay = sent_at + gap - loop.time()
+                if delay > 0:
+                    # look again afterwards: a new command may go first, or drop this one
+                    await asyncio.sleep(delay)
+                    continue
+            if self._control:
+                self._control.popleft()
+            else:
+                self._queue.pop()
+                if loop.time() - command.queued_at > COMMAND_MAX_AGE:
+                    command.future.cancel()
+                    continue
+
+            telegram, ack_type, future = command.telegram, command.reply_type, command.future
+            if future.cancelled():
+                continue
+            burst = None
+            step = HEADER_SIZE + telegram[2]
+            if command.cmd_class == CMD_VOLUME and len(command.mlns) == 1 and len(telegram) != step:
+                # a volume burst is written step by step. The rest of it waits in the queue, where a STANDBY can still
+                # drop it, and keeps the future until the last step is written.
+                self._queue.requeue(command._replace(telegram=telegram[step:]))
+                telegram, burst = telegram[:step], command.seq
+            transport.write(telegram)
+            now = sent_at = loop.time()
+            # a batch of commands is written at once, but accounted for telegram by telegram
+            for sent in iter_telegrams(telegram):
+                self.metrics.telegram_sent(sent, now)
+                if self._capture is not None:
+                    self._capture.write(CAPTURE_SENT, sent)
+                if self.telegramlogging:
+                    _LOGGER.info("mlgw: >SENT: %s: %s", _getpayloadtypestr(sent[1]), TelegramStr(sent))  # debug
+
+            if burst is not None:
+                continue
+            if ack_type is None:
+                future.set_result(None)
+            else:
+                # the next telegram goes out as soon as this one is acknowledged
+                self._await_reply(ack_type, future)
+                await asyncio.wait((future,), timeout=ACK_TIMEOUT)
+
+    ## Have the next reply of reply_type resolve the future of a request that was written. The future is cancelled
+    ## if no reply arrives within REQUEST_TIMEOUT.
+    def _await_reply(self, reply_type, future):
+        waiters = self._waiters.setdefault(reply_type, deque())
+        waiters.append(future)
+        expiry = asyncio.get_running_loop().call_later(REQUEST_TIMEOUT, future.cancel)
+
+        def done(_future):
+            expiry.cancel()
+            if future in waiters:
+                # expired, or given up by the caller: a later reply is not for this request
+                waiters.remove(future)
+        future.add_done_callback(done)
+
+    ## Whether the last Source Status of an MLN says it is on the named source, and no command has been sent to it
+    ## since that could have changed it
+    def source_selected(self, mln, source):
+        status = self._source_status.get(mln)
+        if status is None or status.activity == SOURCE_STANDBY:
+            return False
+        if status.source != reverse_selectedsourcedict.get(source.upper()):
+            return False
+        self.commands_skipped += 1
+        return True
+
+    ## A power or source command makes the last Source Status of its MLN, or of every MLN, out of date
+    def _source_status_outdated(self, mln, dest, cmd):
+        if COMMAND_CLASSES.get(cmd) in (CMD_POWER, CMD_SOURCE) and self._source_status:
+            if dest == reverse_destselectordict.get('ALL PRODUCTS'):
+                self._source_status.clear()
+            else:
+                self._source_status.pop(mln, None)
 
     ## Send Beo4 command to mlgw
     def send_beo4_cmd(self, mln, dest, cmd):
-        self._payload = bytearray()
-        self._payload.append(mln)              # byte[0] MLN
-        self._payload.append(dest)             # byte[1] Dest-Sel (0x00, 0x01, 0x05, 0x0f)
-        self._payload.append(cmd)              # byte[2] Beo4 Command
-        self._payload.append(0x00)             # byte[3] Sec-Source
-        self._payload.append(0x00)             # byte[3] Link
-        self.send(0x01, self._payload)
+        self._source_status_outdated(mln, dest, cmd)
+        return self.send_telegram(encode_beo4_cmd(mln, dest, cmd))
 
     ## Send Beo4 commmand and store the source name
     def send_beo4_cmd_source(self, mln, dest, source):
         self._source = source
-        self.send_beo4_cmd(mln, dest, BEO4_CMDS.get(source))
+        return self.send_beo4_cmd(mln, dest, BEO4_CMDS.get(source))
+
+    ## Send Beo4 commands, given as (mln, dest, cmd), in a single write
+    def send_beo4_cmds(self, commands):
+        for mln, dest, cmd in commands:
+            self._source_status_outdated(mln, dest, cmd)
+        return self.send_telegram(encode_batch([encode_beo4_cmd(mln, dest, cmd) for mln, dest, cmd in commands]))
+
+    ## Send steps VOLUME UP commands to an MLN, or VOLUME DOWN commands if steps is negative. They are queued as one
+    ## burst, and written VOLUME_STEP_GAP apart; the future is resolved once the last step is written.
+    def send_volume_steps(self, mln, steps):
+        cmd = BEO4_CMDS.get('VOLUME UP') if steps > 0 else BEO4_CMDS.get('VOLUME DOWN')
+        return self.send_beo4_cmds([(mln, reverse_destselectordict.get('AUDIO SOURCE'), cmd)] * abs(steps))
+
+    ## Put every product on the Masterlink in standby with a single All Products telegram
+    def all_standby(self):
+        for device in self.devices:
+            device.set_state(STATE_OFF)
+        mln = self.devices[0].mln if self.devices else 1
+        return self.send_beo4_cmd(mln, reverse_destselectordict.get('ALL PRODUCTS'), BEO4_CMDS.get('STANDBY'))
+
+    ## Put some of the devices in standby, one telegram each, or every product on the Masterlink if devices is None.
+    ## Only None sends All Products: that also reaches products that are not configured as devices.
+    def group_standby(self, devices=None):
+        if devices is None:
+            return self.all_standby()
+        for device in devices:
+            device.set_state(STATE_OFF)
+        dest = reverse_destselectordict.get('AUDIO SOURCE')
+        return self.send_beo4_cmds([(device.mln, dest, BEO4_CMDS.get('STANDBY')) for device in devices])
+
+    ## Select the same source on some of the devices, or all of them if devices is None. The source is shared by
+    ## the whole Masterlink, so it is stored once and every device is switched on in one pass. Devices already on
+    ## the source are left alone.
+    def group_select_source(self, source, devices=None):
+        if devices is None:
+            devices = self.devices
+        devices = [device for device in devices if not (device.state == STATE_ON and self.source_selected(device.mln, source))]
+        if not devices:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(None)
+            return future
+        source_changed = source != self._source
+        self._source = source
+        written = {device.mln for device in devices if device.set_state(STATE_ON)}
+        if source_changed:
+            for device in self.devices:
+                if device.mln not in written:
+                    device._async_state_changed()
+        dest = reverse_destselectordict.get('AUDIO SOURCE')
+        return self.send_beo4_cmds([(device.mln, dest, BEO4_CMDS.get(source)) for device in devices])
 
     def send_virtual_btn_press(self, btn):
-        self.send(0x20, [btn])
+        return self.send_telegram(encode_virtual_btn_press(btn))
 
-    def _listen(self):
-        while not self.stopped.isSet():
+    ## Get serial number of mlgw
+    async def async_get_serial(self):
+        try:
+            reply = await self.async_request(SERIAL_REQUEST_TELEGRAM)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            _LOGGER.error("Serial number request to ML Gateway failed: %r", e)
+            return None
+        self._set_serial(str(reply[4:4+reply[2]], 'utf-8'))
+        return self._serial
+
+    def _set_serial(self, serial):
+        _LOGGER.info("mlgw: Serial number of ML Gateway is " + serial)
+        if serial != self._serial:
+            self._serial = serial
+            if self.serial_listener is not None:
+                self.serial_listener(self)
+
+    ## Heartbeat. Every telegram received shows the link is alive, so the gateway is only pinged after
+    ## heartbeat_interval seconds without any, and a busy link is not pinged at all. When nothing arrives within
+    ## heartbeat_timeout seconds of a ping, the connection is closed: the devices become unavailable straight away,
+    ## and commands are buffered until the supervisor has reconnected.
+    def _heartbeat(self):
+        self._heartbeat_handle = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self._heartbeat_sent is not None and self._last_rx < self._heartbeat_sent:
+            if now < self._heartbeat_sent + self._heartbeat_timeout:
+                self._heartbeat_handle = loop.call_at(self._heartbeat_sent + self._heartbeat_timeout, self._heartbeat)
+                return
+            self.heartbeat_failures += 1
+            _LOGGER.error("No reply from ML Gateway %s within %d s of a ping", self.gateway_id, self._heartbeat_timeout)
+            self.close()
+            return
+        self._heartbeat_sent = None
+        idle = now - self._last_rx
+        if idle >= self._heartbeat_interval:
+            self._heartbeat_sent = now
+            self.ping()
+            self._heartbeat_handle = loop.call_later(self._heartbeat_timeout, self._heartbeat)
+        else:
+            self._heartbeat_handle = loop.call_later(self._heartbeat_interval - idle, self._heartbeat)
+
+    def _connection_made(self, transport):
+        self._transport = transport
+
+    def _connection_lost(self, transport, exc):
+        if transport is not self._transport:
+            return  # an earlier connection
+        if self.connected and not self._stopped:
+            _LOGGER.error("Lost connection to ML Gateway: %s", exc)
+        self.close()
+
+    ## Take a complete telegram received from mlgw. Called on the event loop by the protocol.
+    #
+    #   The telegram is a view into the receive buffer. Only the counters and the capture are updated here: the
+    #   telegram is copied into the ingest queue and processed later by _process_ingest, a batch at a time, so that
+    #   a slow consumer does not hold up reading from the gateway.
+    #
+    def _telegram_received(self, response):
+        loop = asyncio.get_running_loop()
+        self._last_rx = loop.time()
+        self.metrics.telegram_received(response, self._last_rx)
+        if self._capture is not None:
+            self._capture.write(CAPTURE_RECEIVED, response)
+        self._ingest.push(response)
+        if self._ingest_handle is None:
+            self._ingest_handle = loop.call_soon(self._process_ingest)
+        if len(self._ingest) >= INGEST_QUEUE_SIZE and not self._reading_paused and self.connected:
+            self._reading_paused = True
+            self.reading_pauses += 1
+            self._transport.pause_reading()
+
+    ## Process queued telegrams, and fire the events they cause, for up to INGEST_TIME_BUDGET, and come back for the
+    ## rest in the next event loop iteration
+    #
+    #   The events are fired within the budget too: a slow bus then makes the telegrams queue up, and the ingest
+    #   queue policy and the pausing of reads apply, rather than holding up reading from the gateway. A telegram is
+    #   only taken from the queue once the events of the ones before it have been fired.
+    #
+    def _process_ingest(self):
+        self._ingest_handle = None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + INGEST_TIME_BUDGET
+        while self._events.fire_pending(deadline) and self._ingest and loop.time() < deadline:
+            telegram = self._ingest.pop()
             try:
-                response = self._socket.recv(self.buffersize)
-            except KeyboardInterrupt:
-                self.close()
-            except socket.timeout:
-                # Ping the gateway to test the connection
-                self.ping()
+                self._process_telegram(telegram)
+            except Exception:   # one bad telegram must not stop the processing of the others
+                _LOGGER.exception("Error processing telegram %s", telegram.hex())
+        if self._ingest or self._events.pending:
+            self._ingest_handle = loop.call_soon(self._process_ingest)
+        if self._reading_paused and len(self._ingest) <= INGEST_RESUME_AT:
+            self._reading_paused = False
+            self._transport.resume_reading()
+
+    ## Decode a received telegram and act on it
+    def _process_telegram(self, response):
+        # Decode response. Response[0] is SOH, or 0x01
+        # The payload is only decoded to text if a log record is actually emitted
+        msg_byte = response[1]
+        msg_type = _getpayloadtypestr(msg_byte)
+        msg_payload = TelegramStr(response)
+
+        _LOGGER.debug('Msg type: %s. Payload: %s', msg_type, msg_payload)
+
+        # replies to our own requests go to the oldest request still waiting for one
+        waiters = self._waiters.get(msg_byte)
+        while waiters:
+            future = waiters.popleft()
+            if future.done():
                 continue
+            future.set_result(response)
+            return
 
-            if response is not None:
-                # Decode response. Response[0] is SOH, or 0x01
-                msg_byte = response[1]
-                msg_type = _getpayloadtypestr(msg_byte)
-                msg_payload = _getpayloadstr(response)
-
-                _LOGGER.debug(f'Msg type: {msg_type}. Payload: {msg_payload}')
-
-                if msg_byte == 0x20: # Virtual Button event
-                    virtual_btn = response[4]
-                    if len(response)<5:
-                        virtual_action = _getvirtualactionstr(0x01)
-                    else: 
-                        virtual_action = _getvirtualactionstr(response[5])
-                    _LOGGER.info(f'Virtual button pressed: button {virtual_btn} action {virtual_action}' )
-                    self._hass.bus.fire("bangolufsen_virtual_button", {"button": virtual_btn, "action": virtual_action})
-
-                elif msg_byte == 0x31: # Login Status
-                    if msg_payload == 'FAIL':
-                        _LOGGER.info('Login needed')
-                        self.login()
-                    elif msg_payload == 'OK':
-                        _LOGGER.info('Login successful')
-                        self.get_serial()
-
-                elif msg_byte == 0x37: # Pong (Ping response)
-                    _LOGGER.info('pong')
-
-                elif msg_byte == 0x02: # Source status
-                    _LOGGER.info(f'Msg type: {msg_type}. Payload: {msg_payload}')
-                    self._sourceMLN = _getmlnstr( response[4] ) 
-                    self._source = _getselectedsourcestr( response[5] ).upper()
-                    self._sourceMediumPosition = _hexword( response[6], response[7] )
-                    self._sourcePosition = _hexword( response[8], response[9] )
-                    self._sourceActivity = _getdictstr( sourceactivitydict, response[10] )
-                    self._pictureFormat = _getdictstr( pictureformatdict, response[11] )
-
-                elif msg_byte == 0x05: # All Standby
-                    _LOGGER.info(f'Msg type: {msg_type}. Payload: {msg_payload}')
-                    if self._devices is not None: # set all connected devices state to off
-                        for i in self._devices:
-                            i.set_state(STATE_OFF)
-
-                elif msg_byte == 0x04: # Light / Control command
-                    lcroom = _getroomstr( response[4] )
-                    lctype = _getdictstr( lctypedict, response[5] )
-                    lccommand = _getbeo4commandstr( response[6] )
-                    _LOGGER.info(f'Light/Control command: room: {lcroom} type: {lctype} command {lccommand}')
-                    self._hass.bus.fire("bangolufsen_light_control_event", {"room": response[4], "type": lctype, "command": lccommand})
+        handler = self._handlers.get(msg_byte)
+        if handler is None:
+            _LOGGER.info('Msg type: %s. Payload: %s', msg_type, msg_payload)
+            return
+        msg = decode(response)
+        if type(msg) is UnknownTelegram:
+            _LOGGER.warning('Malformed telegram: %s: %s', msg_type, bytes(response).hex())
+            return
+        handler(msg)
+
+    def _on_virtual_button(self, msg):
+        virtual_action = _getvirtualactionstr(msg.action)
+        _LOGGER.info('Virtual button pressed: button %s action %s', msg.button, virtual_action)
+        self._events.virtual_button(msg.button, virtual_action)
+
+    def _on_login_status(self, msg):
+        login_status = _getdictstr( loginstatusdict, msg.status )
+        if login_status == 'OK':
+            if self.handshake_state != HANDSHAKE_READY:
+                _LOGGER.info('Login successful')
+                self._handshake_done()
+        elif login_status == 'FAIL':
+            if self.handshake_state == HANDSHAKE_READY:
+                _LOGGER.info('Login needed')
+                self._start_handshake()
+            elif self.handshake_state == HANDSHAKE_LOGIN:
+                self._login_failures += 1
+                if self._login_failures > 1:
+                    self._login_failed()
+
+    def _on_pong(self, msg):
+        _LOGGER.info('pong')
+        self._pong_received = True
+
+    def _on_serial_number(self, msg):
+        self._set_serial(msg.serial)
+
+    def _on_source_status(self, msg):
+        if self._source_status.get(msg.mln) == msg:
+            return  # nothing changed
+        self._source_status[msg.mln] = msg
+        _LOGGER.info('Source status: %s', msg)
+        if msg.activity == SOURCE_STANDBY:
+            device = self._devices_by_mln.get(msg.mln)
+            if device is not None:
+                device.set_state(STATE_OFF)
+            return
+        source = _getselectedsourcestr( msg.source ).upper()
+        if source != self._source:
+            self._source = source
+            # the source is shared by all the devices on the Masterlink, and only shown for the ones that are on
+            for device in self.devices:
+                if device.state == STATE_ON:
+                    device._async_state_changed()
+
+    def _on_pictsnd_status(self, msg):
+        device = self._devices_by_mln.get(msg.mln)
+        if device is not None:
+            device.set_pictsnd_status(msg)
+
+    def _on_all_standby(self, msg):
+        _LOGGER.info('All standby')
+        if self._devices is not None: # set all connected devices state to off
+            for i in self._devices:
+                i.set_state(STATE_OFF)
+
+    def _on_light_control(self, msg):
+        lcroom = _getroomstr( msg.room )
+        lctype = _getdictstr( lctypedict, msg.type )
+        lccommand = _getbeo4commandstr( msg.command )
+        _LOGGER.info('Light/Control command: room: %s type: %s command %s', lcroom, lctype, lccommand)
+        self._events.light_control(msg.room, lctype, lccommand)
 
-                else:
-                    _LOGGER.info(f'Msg type: {msg_type}. Payload: {msg_payload}')
 
-    ## Receive message from mlgw
-    def receive(self):
-        if self.connected:
-            try:
-                self._mlgwdata = self._socket.recv(self.buffersize)
-            except socket.timeout:
-                pass
-            except KeyboardInterrupt:
-                _LOGGER.error("mlgw: KeyboardInterrupt, terminating...")
-                self.close()
-
-            self._payloadstr = _getpayloadstr(self._mlgwdata)
-            if self._mlgwdata[0] != 0x01:
-                _LOGGER.error("mlgw: Received telegram with SOH byte <> 0x01")
-            if self._mlgwdata[3] != 0x00:
-                _LOGGER.error("mlgw: Received telegram with spare byte <> 0x00")
-            if self.telegramlogging:
-                _LOGGER.info("mlgw: <RCVD: '" + _getpayloadtypestr(self._mlgwdata[1]) + "': " + str(self._payloadstr))  # debug
-            return (self._mlgwdata[1], str(self._payloadstr))
+"""
+_EventDispatcher fires the virtual button and light/control events on the Home Assistant bus, and hands them to the
+matching subscribers (see subscriptions.py).
 
-    ## Get serial number of mlgw
-    def get_serial(self):
-        if self.connected:
-            # Request serial number
-            self.send(0x39, '')
-            (result, self._serial) = self.receive()
-            _LOGGER.warning("mlgw: Serial number of ML Gateway is " + self._serial)  # info
+Events are handed over on the event loop. They are collected while the received telegrams are processed, and fired
+by fire_pending(), which MLGateway calls within the time budget it processes telegrams in. With coalesce_hold, the
+repeats sent while a button is held are reduced to a press, a hold-start and a release event.
+
+"""
+class _EventDispatcher:
+    SUPPRESSED = 'suppressed'
+
+    def __init__(self, hass, coalesce_hold=False, subscriptions=None):
+        self._hass = hass
+        # subscribers indexed by event data, called along with the bus event
+        self._subscribers = {}
+        if subscriptions is not None:
+            self._subscribers = {
+                EVENT_LIGHT_CONTROL: subscriptions.light_control,
+                EVENT_VIRTUAL_BUTTON: subscriptions.virtual_button,
+            }
+        self._loop = asyncio.get_running_loop()
+        self._coalesce_hold = coalesce_hold
+        self._pending = deque()
+        self._held = {}
+        self._counts = Counter()
+        self._window_start = self._loop.time()
+        self._events_per_second = {}
+
+    @property
+    def events_per_second(self):
+        self._roll_window()
+        return self._events_per_second
+
+    def virtual_button(self, button, action):
+        if self._coalesce_hold:
+            if action == 'HOLD':
+                if button in self._held:
+                    self._suppress()
+                    return
+                self._held[button] = True
+            else:
+                self._held.pop(button, None)
+        self._fire(EVENT_VIRTUAL_BUTTON, {"button": button, "action": action})
+
+    def light_control(self, room, lctype, command):
+        if self._coalesce_hold:
+            # a held key repeats the same command until a Key Release
+            key = (room, lctype)
+            now = self._loop.time()
+            last_command, repeats, last_seen = self._held.get(key, (None, 0, 0))
+            if command == 'Key Release':
+                self._held.pop(key, None)
+            elif command == last_command and now - last_seen < HOLD_REPEAT_WINDOW:
+                self._held[key] = (command, repeats + 1, now)
+                if repeats >= 1:
+                    self._suppress()
+                    return
+            else:
+                self._held[key] = (command, 0, now)
+        self._fire(EVENT_LIGHT_CONTROL, {"room": room, "type": lctype, "command": command})
+
+    ## Whether there are events waiting for fire_pending()
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    ## Fire the waiting events, oldest first, until the deadline (event loop time) has passed. Returns True once none
+    ## are left.
+    def fire_pending(self, deadline):
+        pending = self._pending
+        if not pending:
+            return True
+        self._roll_window()
+        while pending:
+            event_type, data = pending.popleft()
+            self._counts[event_type] += 1
+            self._hass.bus.async_fire(event_type, data)
+            dispatch = self._subscribers.get(event_type)
+            if dispatch is not None:
+                dispatch(data)
+            if self._loop.time() >= deadline:
+                break
+        return not pending
+
+    def _fire(self, event_type, data):
+        self._pending.append((event_type, data))
+
+    def _suppress(self):
+        self._roll_window()
+        self._counts[self.SUPPRESSED] += 1
+
+    def _roll_window(self):
+        now = self._loop.time()
+        if now - self._window_start >= 1:
+            # counts older than the last complete second are stale
+            self._events_per_second = dict(self._counts) if now - self._window_start < 2 else {}
+            self._counts.clear()
+            self._window_start = now
+
+
+"""
+_Command is a telegram waiting in one of the MLGateway send queues.
+
+"""
+class _Command(NamedTuple):
+    telegram: bytes
+    reply_type: Optional[int]   # type of the reply the gateway sends, for requests
+    future: asyncio.Future
+    queued_at: float
+    cmd_class: int = CMD_OTHER      # set by _CommandScheduler
+    mlns: FrozenSet[int] = frozenset()  # the MLNs of the Beo4 commands, set by _CommandScheduler
+    seq: int = 0                    # queueing order, set by _CommandScheduler
+
+
+"""
+_CommandScheduler holds the commands waiting for the gateway, in priority classes (see COMMAND_CLASSES). Commands for
+the same MLN are sent in the order they were queued, whatever their class: priority only lets a command go ahead of
+those queued for other MLNs.
+
+A new command drops the queued commands it makes obsolete: STANDBY drops the source selections and volume steps
+queued for its MLNs, or for every MLN when sent to All Products, MUTE and SLEEP drop the volume steps queued for their
+MLNs, including the rest of a burst being written, a source selection drops an older one for the same MLN, and a burst of volume steps drops the volume steps queued for its MLN. A batch for several MLNs only loses the
+telegrams for those MLNs. Each MLN can have at most COMMAND_MLN_LIMIT commands queued: further volume steps are
+refused, other commands replace the oldest, lowest priority command of the MLN. When the whole queue is full, the
+oldest command of the lowest priority goes. Power commands are never dropped to make room, and always accepted: a
+command that could only take the place of power commands is refused instead. Dropped and refused commands have their
+future cancelled, and are counted in `dropped`.
+
+"""
+class _CommandScheduler:
+    def __init__(self, size=COMMAND_BUFFER_SIZE, mln_limit=COMMAND_MLN_LIMIT):
+        self._queues = tuple(deque() for _ in range(max(COMMAND_PRIORITY.values()) + 1))
+        # the queues commands may be dropped from to make room: all but the power commands
+        self._evictable = self._queues[COMMAND_PRIORITY[CMD_POWER] + 1:]
+        self._size = size
+        self._mln_limit = mln_limit
+        self._per_mln = Counter()
+        self._len = 0
+        self._seq = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._len
+
+    ## Queue a command. Returns False if it was refused.
+    def push(self, command):
+        telegram = command.telegram
+        cmd_class, mlns = CMD_OTHER, frozenset()
+        if telegram[1] == 0x01:     # Beo4 Command, or a batch of them
+            cmd = telegram[6]
+            cmd_class = COMMAND_CLASSES.get(cmd, CMD_OTHER)
+            batch = len(telegram) != HEADER_SIZE + telegram[2]
+            mlns = frozenset(sent[4] for sent in iter_telegrams(telegram)) if batch else frozenset((telegram[4],))
+            if cmd == BEO4_CMDS['STANDBY']:
+                if telegram[5] == reverse_destselectordict['ALL PRODUCTS']:
+                    self._drop(lambda queued: queued.cmd_class in (CMD_SOURCE, CMD_VOLUME))
+                else:
+                    self._drop_for(mlns, (CMD_SOURCE, CMD_VOLUME))
+            elif cmd_class == CMD_POWER:
+                # volume steps would undo a MUTE, and would keep it waiting behind them
+                self._drop_for(mlns, (CMD_VOLUME,))
+            elif cmd_class == CMD_SOURCE:
+                self._drop_for(mlns, (CMD_SOURCE,))
+            elif cmd_class == CMD_VOLUME and batch and len(mlns) == 1:
+                # a volume burst is worked out from the reported volume, which the queued steps have not changed yet
+                self._drop_for(mlns, (CMD_VOLUME,))
+
+        if cmd_class != CMD_POWER:
+            full = [mln for mln in mlns if self._per_mln[mln] >= self._mln_limit]
+            if full and (cmd_class == CMD_VOLUME or None in map(self._oldest, full)) or \
+                    self._len >= self._size and not any(self._evictable):
+                self.dropped += 1
+                command.future.cancel()
+                return False
+            # make room by dropping the oldest, lowest priority command of the MLN
+            for mln in full:
+                self._remove(*self._oldest(mln), {mln})
+        if self._len >= self._size:
+            for queue in reversed(self._evictable):
+                if queue:
+                    self._discard(queue.popleft())
+                    break
+
+        self._seq += 1
+        self._queues[COMMAND_PRIORITY[cmd_class]].append(command._replace(cmd_class=cmd_class, mlns=mlns,
+                                                                          seq=self._seq))
+        self._len += 1
+        self._per_mln.update(mlns)
+        return True
+
+    ## The next command to send, without taking it from the queue, or None
+    def peek(self):
+        command = next((queue[0] for queue in self._queues if queue), None)
+        if command is None:
+            return None
+        # an earlier command for one of the same MLNs goes first
+        while True:
+            earlier = [queued for queue in self._queues for queued in queue
+                       if queued.seq < command.seq and queued.mlns & command.mlns]
+            if not earlier:
+                return command
+            command = min(earlier, key=lambda queued: queued.seq)
+
+    ## Take the next command to send, or None
+    def pop(self):
+        command = self.peek()
+        if command is not None:
+            self._queues[COMMAND_PRIORITY[command.cmd_class]].remove(command)
+            self._len -= 1
+            self._per_mln.subtract(command.mlns)
+        return command
+
+    ## Put the rest of a popped command back at the front of its class, where it keeps its place in the order of its
+    ## MLNs
+    def requeue(self, command):
+        self._queues[COMMAND_PRIORITY[command.cmd_class]].appendleft(command)
+        self._len += 1
+        self._per_mln.update(command.mlns)
+
+    def cancel_all(self):
+        for queue in self._queues:
+            while queue:
+                queue.popleft().future.cancel()
+        self._per_mln.clear()
+        self._len = 0
+
+    ## Where the oldest, lowest priority command of the MLN that is not a power command is queued: (queue, index), or
+    ## None
+    def _oldest(self, mln):
+        for queue in reversed(self._evictable):
+            for index, queued in enumerate(queue):
+                if mln in queued.mlns:
+                    return queue, index
+        return None
+
+    def _drop(self, obsolete):
+        for queue in self._queues:
+            if any(obsolete(queued) for queued in queue):
+                kept = [queued for queued in queue if not obsolete(queued)]
+                for queued in queue:
+                    if obsolete(queued):
+                        self._discard(queued)
+                queue.clear()
+                queue.extend(kept)
+
+    ## Drop the telegrams for any of the MLNs from the queued commands of the classes
+    def _drop_for(self, mlns, classes):
+        for queue in self._queues:
+            for index in reversed(range(len(queue))):
+                queued = queue[index]
+                if queued.cmd_class in classes and queued.mlns & mlns:
+                    self._remove(queue, index, mlns)
+
+    ## Take the telegrams for the MLNs out of a queued command, and the command itself if it has no others left
+    def _remove(self, queue, index, mlns):
+        queued = queue[index]
+        if queued.mlns <= mlns:
+            del queue[index]
+            self._discard(queued)
+            return
+        # the rest of the batch is still sent, and keeps the future
+        telegrams = [sent for sent in iter_telegrams(queued.telegram) if sent[4] not in mlns]
+        queue[index] = queued._replace(telegram=encode_batch(telegrams), mlns=queued.mlns - mlns)
+        self._per_mln.subtract(queued.mlns & mlns)
+        self.dropped += 1
+
+    ## Account for a command removed from its queue
+    def _discard(self, command):
+        command.future.cancel()
+        self.dropped += 1
+        self._len -= 1
+        self._per_mln.subtract(command.mlns)
+
+
+## Turn on TCP keepalive, so that the kernel notices a dead link too, e.g. while a write is waiting for the gateway.
+## The options beyond SO_KEEPALIVE are set where the platform has them.
+def _set_keepalive(sock):
+    if sock is None:
         return
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    idle = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))  # TCP_KEEPALIVE on macOS
+    for option, value in ((idle, KEEPALIVE_IDLE),
+                          (getattr(socket, 'TCP_KEEPINTVL', None), KEEPALIVE_INTERVAL),
+                          (getattr(socket, 'TCP_KEEPCNT', None), KEEPALIVE_COUNT),
+                          (getattr(socket, 'TCP_USER_TIMEOUT', None),
+                           (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT) * 1000)):
+        if option is not None:
+            options.append((socket.IPPROTO_TCP, option, value))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            _LOGGER.debug("Could not set socket option %s: %s", option, e)
 
 
-def _hexbyte(byte):
-    resultstr = hex(byte)
-    if byte < 16:
-        resultstr = resultstr[:2] + "0" + resultstr[2]
-    return resultstr
-
-def _hexword(byte1, byte2):
-    resultstr = _hexbyte(byte2)
-    resultstr = _hexbyte(byte1) + resultstr[2:]
-    return resultstr
-
-# ########################################################################################
-# ##### MLGW Protocol packet constants
-
-payloadtypedict = dict([
-    (0x01, "Beo4 Command"), (0x02, "Source Status"), (0x03, "Pict&Snd Status"),
-    (0x04, "Light and Control command"), (0x05, "All standby notification"),
-    (0x06, "BeoRemote One control command"), (0x07, "BeoRemote One source selection"),
-    (0x20, "MLGW virtual button event"), (0x30, "Login request"), (0x31, "Login status"),
-    (0x32, "Change password request"), (0x33, "Change password response"),
-    (0x34, "Secure login request"), (0x36, "Ping"), (0x37, "Pong"),
-    (0x38, "Configuration change notification"), (0x39, "Request Serial Number"),
-    (0x3a, "Serial Number"), (0x40, "Location based event")
-    ])
-
-beo4commanddict = dict([
-    # Source selection:
-    (0x0c, "Standby"), (0x47, "Sleep"), (0x80, "TV"), (0x81, "Radio"), (0x82, "DTV2"),
-    (0x83, "Aux_A"), (0x85, "V.Mem"), (0x86, "DVD"), (0x87, "Camera"), (0x88, "Text"),
-    (0x8a, "DTV"), (0x8b, "PC"), (0x0d, "Doorcam"), (0x91, "A.Mem"), (0x92, "CD"),
-    (0x93, "N.Radio"), (0x94, "N.Music"), (0x97, "CD2"),
-    # Digits:
-    (0x00, "Digit-0"), (0x01, "Digit-1"), (0x02, "Digit-2"), (0x03, "Digit-3"),
-    (0x04, "Digit-4"), (0x05, "Digit-5"), (0x06, "Digit-6"), (0x07, "Digit-7"),
-    (0x08, "Digit-8"), (0x09, "Digit-9"),
-    # Source control:
-    (0x1e, "STEP_UP"), (0x1f, "STEP_DW"), (0x32, "REWIND"), (0x33, "RETURN"),
-    (0x34, "WIND"), (0x35, "Go / Play"), (0x36, "Stop"), (0xd4, "Yellow"),
-    (0xd5, "Green"), (0xd8, "Blue"), (0xd9, "Red"),
-    # Sound and picture control
-    (0x0d, "Mute"), (0x1c, "P.Mute"), (0x2a, "Format"), (0x44, "Sound / Speaker"),
-    (0x5c, "Menu"), (0x60, "Volume UP"), (0x64, "Volume DOWN"), (0xda, "Cinema_On"),
-    (0xdb, "Cinema_Off"),
-    # Other controls:
-    (0x14, "BACK"), (0x7f, "Exit"),
-    # Continue functionality:
-    (0x7e, "Key Release"),
-    # Functions:
-    # Cursor functions:
-    (0x13, "SELECT"), (0xca, "Cursor_Up"), (0xcb, "Cursor_Down"), (0xcc, "Cursor_Left"),
-    (0xcd, "Cursor_Right"),
-    #    
-    (0x9b, "Light"),  (0x9c, "Command"),
-    #  Dummy for 'Listen for all commands'
-    (0xff, "<all>")
-    ])
-
-BEO4_CMDS = {v.upper(): k for k, v in beo4commanddict.items()}
-
-destselectordict = dict([
-    (0x00, "Video Source"), (0x01, "Audio Source"), (0x05, "V.TAPE/V.MEM"), (0x0f, "All Products")
-    ])
-
-reverse_destselectordict = {v.upper(): k for k, v in destselectordict.items()}
-
-virtualactiondict = dict([
-    (0x01, "PRESS"), (0x02, "HOLD"), (0x03, "RELEASE")
-    ])
-
-selectedsourcedict = dict( [
-    (0x0b, "TV"), (0x15, "V.Mem"), (0x1f, "DTV"), (0x29, "DVD"), 
-    (0x6f, "Radio"), (0x79, "A.Mem"), (0x8d, "CD"),
-    #  Dummy for 'Listen for all sources'
-    (0xfe, "<all>")
-    ] )
-    
-reverse_selectedsourcedict = {v.upper(): k for k, v in selectedsourcedict.items()}
-
-sourceactivitydict = dict( [
-    (0x00, "Unknown"), (0x01, "Stop"), (0x02, "Playing"), (0x03, "Wind"), 
-    (0x04, "Rewind"), (0x05, "Record lock"), (0x06, "Standby")
-    ] )
-
-pictureformatdict = dict( [
-    (0x00, "Not known"), (0x01, "Known by decoder"), (0x02, "4:3"), (0x03, "16:9"), 
-    (0x04, "4:3 Letterbox middle"), (0x05, "4:3 Letterbox top"), 
-    (0x06, "4:3 Letterbox bottom"), (0xff, "Blank picture")
-    ] )
-
-
-### for '0x03: Picture and Sound Status'
-soundstatusdict = dict([
-    (0x00, "Not muted"), (0x01, "Muted")
-    ])
-
-speakermodedict = dict([
-    (0x01, "Center channel"), (0x02, "2ch stereo"), (0x03, "Front surround"),
-    (0x04, "4ch stereo"), (0x05, "Full surround"),
-    #  Dummy for 'Listen for all modes'
-    (0xfd, "<all>")
-    ])
-
-reverse_speakermodedict = {v.upper(): k for k, v in speakermodedict.items()}
-
-screenmutedict = dict([
-    (0x00, "not muted"), (0x01, "muted")
-    ])
-
-#screenactivedict = dict( [
-#    (0x00, "not active"), (0x01, "active")
-#    ] )
-
-cinemamodedict = dict( [
-    (0x00, "Cinemamode=off"), (0x01, "Cinemamode=on")
-    ] )
-
-stereoindicatordict = dict( [
-    (0x00, "Mono"), (0x01, "Stereo")
-    ] )
-
-### for '0x04: Light and Control command'
-lctypedict = dict( [
-    (0x01, "LIGHT"), (0x02, "CONTROL")
-    ] )
-
-### for '0x31: Login Status
-loginstatusdict = dict( [
-    (0x00, "OK"), (0x01, "FAIL")
-    ] )
-
-# ########################################################################################
-# ##### Decode MLGW Protocol packet to readable string
-
-## Get decoded string for mlgw packet's payload type
-#
-def _getpayloadtypestr( payloadtype ):
-        result = payloadtypedict.get( payloadtype )
-        if result == None:
-            result = "UNKNOWN (type=" + _hexbyte( payloadtype ) + ")"
-        return str(result)
-
-def _getroomstr( room ):
-    result = "Room=" + str( room )
-    return result
-
-def _getmlnstr( mln ):
-    result = "MLN=" + str( mln )
-    return result
-    
-def _getbeo4commandstr( command ):
-    result = beo4commanddict.get( command )
-    if result == None:
-        result = "Cmd=" + _hexbyte( command )
-    return result
-
-def _getvirtualactionstr( action ):
-    result = virtualactiondict.get( action )
-    if result == None:
-        result = "Action=" + _hexbyte( action )
-    return result
-
-def _getselectedsourcestr( source ):
-    result = selectedsourcedict.get( source )
-    if result == None:
-        result = "Src=" + _hexbyte( source )
-    return result
-
-def _getspeakermodestr( source ):
-    result = speakermodedict.get( source )
-    if result == None:
-        result = "mode=" + _hexbyte( source )
-    return result
-
-def _getdictstr( mydict, mykey ):
-    result = mydict.get( mykey )
-    if result == None:
-        result = _hexbyte( mykey )
-    return result
-
-
-## Get decoded string for a mlgw packet
-#
-#   The raw message (mlgw packet) is handed to this function. 
-#   The result of this function is a human readable string, describing the content
-#   of the mlgw packet
-#
-#  @param message   raw mlgw telegram
-#  @returns         telegram as a human readable string
-#
-def _getpayloadstr( message ):
-    if message[2] == 0:            # payload length is 0
-        resultstr = "[No payload]"
-    elif message[1] == 0x01:       # Beo4 Command
-        resultstr = _getmlnstr( message[4] )
-        resultstr = resultstr + " " + _hexbyte( message[5] )
-        resultstr = resultstr + " " + _getbeo4commandstr(message[6])
-
-    elif message[1] == 0x02:       # Source Status
-        resultstr = _getmlnstr( message[4] ) 
-        resultstr = resultstr + " " + _getselectedsourcestr( message[5] ) 
-        resultstr = resultstr + " " + _hexword( message[6], message[7] )
-        resultstr = resultstr + " " + _hexword( message[8], message[9] )
-        resultstr = resultstr + " " + _getdictstr( sourceactivitydict, message[10] )
-        resultstr = resultstr + " " + _getdictstr( pictureformatdict, message[11] )
-
-    elif message[1] == 0x03:       # Picture and Sound Status
-        resultstr = _getmlnstr( message[4] )
-        if message[5] != 0x00:
-            resultstr = resultstr + " " + _getdictstr( soundstatusdict, message[5] )
-        resultstr = resultstr + " " + _getdictstr( speakermodedict, message[6] )
-        resultstr = resultstr + " Vol=" + str( message[7] )
-        if message[9] != 0x00:
-            resultstr = resultstr + " Scrn:" + _getdictstr( screenmutedict, message[8] )
-        if message[11] != 0x00:
-            resultstr = resultstr + " Scrn2:" + _getdictstr( screenmutedict, message[10] )
-        if message[12] != 0x00:
-            resultstr = resultstr + " " + _getdictstr( cinemamodedict, message[12] )
-        if message[13] != 0x01:
-            resultstr = resultstr + " " + _getdictstr( stereoindicatordict, message[13] )
-
-    elif message[1] == 0x04:       # Light and Control command
-        resultstr = _getroomstr( message[4] ) + " " + _getdictstr( lctypedict, message[5] ) + " " + _getbeo4commandstr( message[6] )
-
-    elif message[1] == 0x30:       # Login request
-        wrk = message[4:4+message[2]]
-        for i in range(0, message[2]):
-            if wrk[i] == 0: wrk[i] = 0x7f
-        wrk = wrk.decode('utf-8')
-        resultstr = wrk.split(chr(0x7f))[0] + " / " + wrk.split(chr(0x7f))[1]
-
-    elif message[1] == 0x31:       # Login status
-        resultstr = _getdictstr( loginstatusdict, message[4] )
-
-    elif message[1] == 0x3a:       # Serial Number
-        resultstr = message[4:4+message[2]].decode('utf-8')
-
-    else:                               # Display raw payload
-        resultstr = ""
-        for i in range(0, message[2]):
-            if i > 0:
-                resultstr = resultstr + " "
-            resultstr = resultstr + _hexbyte(message[4+i])
-    return resultstr
+"""
+_IngestQueue holds the telegrams received from the gateway until they are processed, at most `size` of them. When it
+is full, a telegram is dropped unless its policy (see INGEST_POLICY) keeps it. Status telegrams with the merge policy
+never take more than one place per MLN: a newer one replaces the queued one, which is counted in `merged`. Dropped
+telegrams are counted by message type in `dropped`.
+
+"""
+class _IngestQueue:
+    def __init__(self, size=INGEST_QUEUE_SIZE, policy=None):
+        self._size = size
+        policies = {**INGEST_POLICY, **(policy or {})}
+        self._policy = tuple(policies.get(i, INGEST_DROP) for i in range(256))
+        self._entries = deque()     # [telegram, merge key or None]
+        self._merging = {}          # merge key -> entry
+        self.merged = 0
+        self.dropped = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    ## Queue a copy of a telegram. Returns False if it was dropped.
+    def push(self, telegram):
+        msg_type = telegram[1]
+        policy = self._policy[msg_type]
+        if msg_type == 0x20 and len(telegram) > HEADER_SIZE + 1 and _getvirtualactionstr(telegram[5]) == 'RELEASE':
+            policy = INGEST_KEEP
+        key = None
+        if policy == INGEST_MERGE and len(telegram) > HEADER_SIZE:
+            key = (msg_type, telegram[4])
+            entry = self._merging.get(key)
+            if entry is not None:
+                entry[0] = bytes(telegram)
+                self.merged += 1
+                return True
+        elif policy == INGEST_DROP and len(self._entries) >= self._size:
+            self.dropped[msg_type] += 1
+            return False
+        entry = [bytes(telegram), key]
+        self._entries.append(entry)
+        if key is not None:
+            self._merging[key] = entry
+        return True
+
+    ## The oldest telegram, or None
+    def pop(self):
+        if not self._entries:
+            return None
+        telegram, key = self._entries.popleft()
+        if key is not None:
+            del self._merging[key]
+        return telegram
+
+
+"""
+_MLGWProtocol receives data from the gateway straight into the receive buffer of a TelegramFramer, and hands every
+complete telegram to the MLGateway. It runs on the Home Assistant event loop, so no listener thread is needed.
+
+"""
+class _MLGWProtocol(asyncio.BufferedProtocol):
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._transport = None
+        self._framer = TelegramFramer()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._gateway._connection_made(transport)
+
+    def get_buffer(self, sizehint):
+        return self._framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._framer.buffer_updated(nbytes)
+        for telegram in self._framer:
+            self._gateway._telegram_received(telegram)
+
+    def connection_lost(self, exc):
+        self._gateway._connection_lost(self._transport, exc)
 
 
 if __name__ == '__main__':
@@ -682,15 +1695,14 @@ if __name__ == '__main__':
     ch.setLevel(logging.INFO)
     _LOGGER.addHandler(ch)
 
-    gateway = MLGateway()
-    gateway.connect()
-    # gateway.login()
-    gateway.ping()
-
-    # dining_room = BeoSpeaker(0, 'dining_room', gateway)
-    # dining_room.turn_on()
+    async def _main():
+        gateway = MLGateway('192.168.1.10', 9000, 'admin', 'admin', DEFAULT_SOURCE, AVAILABLE_SOURCES, None)
+        await gateway.async_connect()
 
-    # gateway.close()
-    time.sleep(10)
+        # dining_room = BeoSpeaker(1, 'dining_room', gateway)
+        # await dining_room.async_turn_on()
 
+        await asyncio.sleep(10)
+        gateway.close()
 
+    asyncio.run(_main())
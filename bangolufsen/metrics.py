@@ -0,0 +1,125 @@
+"""
+Counters and latency histograms for the traffic of one Masterlink Gateway connection.
+
+Recording is done on the event loop for every telegram, so it only increments integers. Everything else, names,
+totals and percentiles, is worked out in snapshot(), when somebody asks.
+
+"""
+from bisect import bisect_left
+
+from .mlgw import _getpayloadtypestr
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The last bucket is everything slower.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_BEO4_COMMAND = 0x01
+_STATUS_ECHOES = (0x02, 0x03)   # Source Status, Picture and Sound Status
+_PING = 0x36
+_PONG = 0x37
+
+
+"""
+LatencyHistogram counts latencies into the fixed LATENCY_BUCKETS_MS buckets.
+
+"""
+class LatencyHistogram:
+    __slots__ = ('counts', 'total', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    ## Count a latency given in seconds
+    def observe(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.total += 1
+        self.sum += ms
+
+    ## Upper bound in ms of the bucket holding the given quantile, None if nothing was counted or it is above the
+    ## last bucket
+    def quantile(self, q):
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        buckets = {('le_%d' % bound): count for bound, count in zip(LATENCY_BUCKETS_MS, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {
+            'count': self.total,
+            'mean_ms': self.sum / self.total if self.total else None,
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'buckets': buckets,
+        }
+
+
+"""
+GatewayMetrics is fed every telegram sent and received by MLGateway.
+
+Besides the counts per message type and the bytes in each direction, it times the status telegram a product sends
+back after a Beo4 command to its MLN (the echo), and the round trip of pings.
+
+"""
+class GatewayMetrics:
+    def __init__(self):
+        self.sent = [0] * 256          # telegrams, by message type
+        self.received = [0] * 256
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.echo_latency = {msg_type: LatencyHistogram() for msg_type in _STATUS_ECHOES}
+        self.ping_rtt = None           # seconds, last pong
+        self._command_sent = {}        # MLN -> time of the last Beo4 command not echoed yet
+        self._ping_sent = None
+
+    def telegram_sent(self, telegram, now):
+        msg_type = telegram[1]
+        self.sent[msg_type] += 1
+        self.bytes_out += len(telegram)
+        if msg_type == _BEO4_COMMAND:
+            self._command_sent[telegram[4]] = now
+        elif msg_type == _PING:
+            self._ping_sent = now
+
+    def telegram_received(self, telegram, now):
+        msg_type = telegram[1]
+        self.received[msg_type] += 1
+        self.bytes_in += len(telegram)
+        if msg_type in self.echo_latency:
+            if len(telegram) > 4:
+                sent = self._command_sent.pop(telegram[4], None)
+                if sent is not None:
+                    self.echo_latency[msg_type].observe(now - sent)
+        elif msg_type == _PONG and self._ping_sent is not None:
+            self.ping_rtt = now - self._ping_sent
+            self._ping_sent = None
+
+    ## Forget the commands waiting for an echo, e.g. when the connection is lost
+    def reset_pending(self):
+        self._command_sent.clear()
+        self._ping_sent = None
+
+    def snapshot(self):
+        return {
+            'telegrams_sent': _by_type(self.sent),
+            'telegrams_received': _by_type(self.received),
+            'telegrams_sent_total': sum(self.sent),
+            'telegrams_received_total': sum(self.received),
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'echo_latency': {_getpayloadtypestr(msg_type): histogram.snapshot()
+                             for msg_type, histogram in self.echo_latency.items()},
+            'ping_rtt_ms': self.ping_rtt * 1000 if self.ping_rtt is not None else None,
+        }
+
+
+def _by_type(counts):
+    return {_getpayloadtypestr(msg_type): count for msg_type, count in enumerate(counts) if count}
@@ -0,0 +1,536 @@
+"""
+Masterlink Gateway protocol helpers.
+
+Nothing in here depends on Home Assistant, so the protocol code can be used on its own.
+
+"""
+import functools
+import struct
+from typing import NamedTuple
+
+SOH = 0x01
+# SOH, message type, payload length and a spare byte
+HEADER_SIZE = 4
+MAX_TELEGRAM_SIZE = HEADER_SIZE + 0xff
+
+# ########################################################################################
+# ##### MLGW Protocol packet constants
+
+payloadtypedict = dict([
+    (0x01, "Beo4 Command"), (0x02, "Source Status"), (0x03, "Pict&Snd Status"),
+    (0x04, "Light and Control command"), (0x05, "All standby notification"),
+    (0x06, "BeoRemote One control command"), (0x07, "BeoRemote One source selection"),
+    (0x20, "MLGW virtual button event"), (0x30, "Login request"), (0x31, "Login status"),
+    (0x32, "Change password request"), (0x33, "Change password response"),
+    (0x34, "Secure login request"), (0x36, "Ping"), (0x37, "Pong"),
+    (0x38, "Configuration change notification"), (0x39, "Request Serial Number"),
+    (0x3a, "Serial Number"), (0x40, "Location based event")
+    ])
+
+beo4commanddict = dict([
+    # Source selection:
+    (0x0c, "Standby"), (0x47, "Sleep"), (0x80, "TV"), (0x81, "Radio"), (0x82, "DTV2"),
+    (0x83, "Aux_A"), (0x85, "V.Mem"), (0x86, "DVD"), (0x87, "Camera"), (0x88, "Text"),
+    (0x8a, "DTV"), (0x8b, "PC"), (0x0d, "Doorcam"), (0x91, "A.Mem"), (0x92, "CD"),
+    (0x93, "N.Radio"), (0x94, "N.Music"), (0x97, "CD2"),
+    # Digits:
+    (0x00, "Digit-0"), (0x01, "Digit-1"), (0x02, "Digit-2"), (0x03, "Digit-3"),
+    (0x04, "Digit-4"), (0x05, "Digit-5"), (0x06, "Digit-6"), (0x07, "Digit-7"),
+    (0x08, "Digit-8"), (0x09, "Digit-9"),
+    # Source control:
+    (0x1e, "STEP_UP"), (0x1f, "STEP_DW"), (0x32, "REWIND"), (0x33, "RETURN"),
+    (0x34, "WIND"), (0x35, "Go / Play"), (0x36, "Stop"), (0xd4, "Yellow"),
+    (0xd5, "Green"), (0xd8, "Blue"), (0xd9, "Red"),
+    # Sound and picture control
+    (0x0d, "Mute"), (0x1c, "P.Mute"), (0x2a, "Format"), (0x44, "Sound / Speaker"),
+    (0x5c, "Menu"), (0x60, "Volume UP"), (0x64, "Volume DOWN"), (0xda, "Cinema_On"),
+    (0xdb, "Cinema_Off"),
+    # Other controls:
+    (0x14, "BACK"), (0x7f, "Exit"),
+    # Continue functionality:
+    (0x7e, "Key Release"),
+    # Functions:
+    # Cursor functions:
+    (0x13, "SELECT"), (0xca, "Cursor_Up"), (0xcb, "Cursor_Down"), (0xcc, "Cursor_Left"),
+    (0xcd, "Cursor_Right"),
+    #    
+    (0x9b, "Light"),  (0x9c, "Command"),
+    #  Dummy for 'Listen for all commands'
+    (0xff, "<all>")
+    ])
+
+BEO4_CMDS = {v.upper(): k for k, v in beo4commanddict.items()}
+
+destselectordict = dict([
+    (0x00, "Video Source"), (0x01, "Audio Source"), (0x05, "V.TAPE/V.MEM"), (0x0f, "All Products")
+    ])
+
+reverse_destselectordict = {v.upper(): k for k, v in destselectordict.items()}
+
+virtualactiondict = dict([
+    (0x01, "PRESS"), (0x02, "HOLD"), (0x03, "RELEASE")
+    ])
+
+selectedsourcedict = dict( [
+    (0x0b, "TV"), (0x15, "V.Mem"), (0x1f, "DTV"), (0x29, "DVD"), 
+    (0x6f, "Radio"), (0x79, "A.Mem"), (0x8d, "CD"),
+    #  Dummy for 'Listen for all sources'
+    (0xfe, "<all>")
+    ] )
+    
+reverse_selectedsourcedict = {v.upper(): k for k, v in selectedsourcedict.items()}
+
+sourceactivitydict = dict( [
+    (0x00, "Unknown"), (0x01, "Stop"), (0x02, "Playing"), (0x03, "Wind"), 
+    (0x04, "Rewind"), (0x05, "Record lock"), (0x06, "Standby")
+    ] )
+
+pictureformatdict = dict( [
+    (0x00, "Not known"), (0x01, "Known by decoder"), (0x02, "4:3"), (0x03, "16:9"), 
+    (0x04, "4:3 Letterbox middle"), (0x05, "4:3 Letterbox top"), 
+    (0x06, "4:3 Letterbox bottom"), (0xff, "Blank picture")
+    ] )
+
+
+### for '0x03: Picture and Sound Status'
+soundstatusdict = dict([
+    (0x00, "Not muted"), (0x01, "Muted")
+    ])
+
+speakermodedict = dict([
+    (0x01, "Center channel"), (0x02, "2ch stereo"), (0x03, "Front surround"),
+    (0x04, "4ch stereo"), (0x05, "Full surround"),
+    #  Dummy for 'Listen for all modes'
+    (0xfd, "<all>")
+    ])
+
+reverse_speakermodedict = {v.upper(): k for k, v in speakermodedict.items()}
+
+screenmutedict = dict([
+    (0x00, "not muted"), (0x01, "muted")
+    ])
+
+#screenactivedict = dict( [
+#    (0x00, "not active"), (0x01, "active")
+#    ] )
+
+cinemamodedict = dict( [
+    (0x00, "Cinemamode=off"), (0x01, "Cinemamode=on")
+    ] )
+
+stereoindicatordict = dict( [
+    (0x00, "Mono"), (0x01, "Stereo")
+    ] )
+
+### for '0x04: Light and Control command'
+lctypedict = dict( [
+    (0x01, "LIGHT"), (0x02, "CONTROL")
+    ] )
+
+### for '0x31: Login Status
+loginstatusdict = dict( [
+    (0x00, "OK"), (0x01, "FAIL")
+    ] )
+
+
+# ########################################################################################
+# ##### Decode MLGW Protocol packet to readable string
+#
+#   All lookups are done in precomputed 256-entry tables, one entry per possible byte value,
+#   so decoding a byte is a single tuple index.
+
+_HEXBYTE = tuple("0x%02x" % i for i in range(256))
+_HEXLOW = tuple("%02x" % i for i in range(256))
+
+def _table( mydict, fallback ):
+    return tuple(mydict.get(i, fallback + _HEXBYTE[i]) for i in range(256))
+
+_PAYLOADTYPE_STR = tuple(payloadtypedict.get(i, "UNKNOWN (type=" + _HEXBYTE[i] + ")") for i in range(256))
+_ROOM_STR = tuple("Room=" + str(i) for i in range(256))
+_MLN_STR = tuple("MLN=" + str(i) for i in range(256))
+_BEO4COMMAND_STR = _table(beo4commanddict, "Cmd=")
+_VIRTUALACTION_STR = _table(virtualactiondict, "Action=")
+_SELECTEDSOURCE_STR = _table(selectedsourcedict, "Src=")
+_SPEAKERMODE_STR = _table(speakermodedict, "mode=")
+_SOURCEACTIVITY_STR = _table(sourceactivitydict, "")
+_PICTUREFORMAT_STR = _table(pictureformatdict, "")
+_SOUNDSTATUS_STR = _table(soundstatusdict, "")
+_PICTSND_SPEAKERMODE_STR = _table(speakermodedict, "")
+_SCREENMUTE_STR = _table(screenmutedict, "")
+_CINEMAMODE_STR = _table(cinemamodedict, "")
+_STEREOINDICATOR_STR = _table(stereoindicatordict, "")
+_LCTYPE_STR = _table(lctypedict, "")
+_LOGINSTATUS_STR = _table(loginstatusdict, "")
+
+def _hexbyte(byte):
+    return _HEXBYTE[byte]
+
+def _hexword(byte1, byte2):
+    return _HEXBYTE[byte1] + _HEXLOW[byte2]
+
+## Get decoded string for mlgw packet's payload type
+#
+def _getpayloadtypestr( payloadtype ):
+    return _PAYLOADTYPE_STR[payloadtype]
+
+def _getroomstr( room ):
+    return _ROOM_STR[room]
+
+def _getmlnstr( mln ):
+    return _MLN_STR[mln]
+
+def _getbeo4commandstr( command ):
+    return _BEO4COMMAND_STR[command]
+
+def _getvirtualactionstr( action ):
+    return _VIRTUALACTION_STR[action]
+
+def _getselectedsourcestr( source ):
+    return _SELECTEDSOURCE_STR[source]
+
+def _getspeakermodestr( source ):
+    return _SPEAKERMODE_STR[source]
+
+def _getdictstr( mydict, mykey ):
+    result = mydict.get( mykey )
+    if result is None:
+        result = _HEXBYTE[mykey]
+    return result
+
+
+def _beo4commandpayloadstr( message ):
+    return " ".join((_MLN_STR[message[4]], _HEXBYTE[message[5]], _BEO4COMMAND_STR[message[6]]))
+
+def _sourcestatuspayloadstr( message ):
+    return " ".join((
+        _MLN_STR[message[4]],
+        _SELECTEDSOURCE_STR[message[5]],
+        _HEXBYTE[message[6]] + _HEXLOW[message[7]],
+        _HEXBYTE[message[8]] + _HEXLOW[message[9]],
+        _SOURCEACTIVITY_STR[message[10]],
+        _PICTUREFORMAT_STR[message[11]],
+    ))
+
+def _pictsndstatuspayloadstr( message ):
+    parts = [_MLN_STR[message[4]]]
+    if message[5] != 0x00:
+        parts.append(_SOUNDSTATUS_STR[message[5]])
+    parts.append(_PICTSND_SPEAKERMODE_STR[message[6]])
+    parts.append("Vol=" + str(message[7]))
+    if message[9] != 0x00:
+        parts.append("Scrn:" + _SCREENMUTE_STR[message[8]])
+    if message[11] != 0x00:
+        parts.append("Scrn2:" + _SCREENMUTE_STR[message[10]])
+    if message[12] != 0x00:
+        parts.append(_CINEMAMODE_STR[message[12]])
+    if message[13] != 0x01:
+        parts.append(_STEREOINDICATOR_STR[message[13]])
+    return " ".join(parts)
+
+def _lightcontrolpayloadstr( message ):
+    return " ".join((_ROOM_STR[message[4]], _LCTYPE_STR[message[5]], _BEO4COMMAND_STR[message[6]]))
+
+def _loginrequestpayloadstr( message ):
+    user, _, password = bytes(message[4:4+message[2]]).partition(b"\x00")
+    return str(user, 'utf-8') + " / " + str(password, 'utf-8')
+
+def _loginstatuspayloadstr( message ):
+    return _LOGINSTATUS_STR[message[4]]
+
+def _serialnumberpayloadstr( message ):
+    return str(message[4:4+message[2]], 'utf-8')
+
+def _rawpayloadstr( message ):
+    return " ".join([_HEXBYTE[b] for b in message[4:4+message[2]]])
+
+_PAYLOAD_STR = {
+    0x01: _beo4commandpayloadstr,       # Beo4 Command
+    0x02: _sourcestatuspayloadstr,      # Source Status
+    0x03: _pictsndstatuspayloadstr,     # Picture and Sound Status
+    0x04: _lightcontrolpayloadstr,      # Light and Control command
+    0x30: _loginrequestpayloadstr,      # Login request
+    0x31: _loginstatuspayloadstr,       # Login status
+    0x3a: _serialnumberpayloadstr,      # Serial Number
+}
+
+
+## Get decoded string for a mlgw packet
+#
+#   The raw message (mlgw packet) is handed to this function. 
+#   The result of this function is a human readable string, describing the content
+#   of the mlgw packet
+#
+#  @param message   raw mlgw telegram
+#  @returns         telegram as a human readable string
+#
+def _getpayloadstr( message ):
+    if message[2] == 0:            # payload length is 0
+        return "[No payload]"
+    return _PAYLOAD_STR.get(message[1], _rawpayloadstr)(message)
+
+
+# ########################################################################################
+# ##### Encode MLGW Protocol packets
+#
+#   Telegrams are built in one step as immutable bytes, so they can be queued and shared freely.
+
+_HEADER = struct.Struct("4B")       # SOH, msg_type, length, spare
+_BEO4_CMD = struct.Struct("9B")     # header, MLN, Dest-Sel, Beo4 Command, Sec-Source, Link
+
+## Build a telegram from its type and payload
+def encode_telegram( msg_type, payload=b"" ):
+    return _HEADER.pack(SOH, msg_type, len(payload), 0x00) + bytes(payload)
+
+## Build a Beo4 command telegram. Telegrams are cached per (MLN, dest, command).
+@functools.lru_cache(maxsize=1024)
+def encode_beo4_cmd( mln, dest, cmd ):
+    return _BEO4_CMD.pack(SOH, 0x01, 5, 0x00, mln, dest, cmd, 0x00, 0x00)
+
+@functools.lru_cache(maxsize=256)
+def encode_virtual_btn_press( btn ):
+    return encode_telegram(0x20, bytes((btn,)))
+
+def encode_login( user, password ):
+    return encode_telegram(0x30, user.encode('utf-8') + b"\x00" + password.encode('utf-8'))
+
+PING_TELEGRAM = encode_telegram(0x36)
+SERIAL_REQUEST_TELEGRAM = encode_telegram(0x39)
+
+## Concatenate telegrams, to be written to the gateway in one go
+def encode_batch( telegrams ):
+    return b"".join(telegrams)
+
+## The telegrams in a buffer holding one or more complete telegrams
+def iter_telegrams( data ):
+    end = HEADER_SIZE + data[2]
+    if end == len(data):
+        yield data
+        return
+    offset = 0
+    while offset < len(data):
+        end = offset + HEADER_SIZE + data[offset + 2]
+        yield data[offset:end]
+        offset = end
+
+
+# ########################################################################################
+# ##### Decoded MLGW Protocol packets
+#
+#   One compact message class per payload type. Fields hold the raw integer values from the
+#   telegram; use the *dict tables above to turn them into names.
+
+class Beo4Command(NamedTuple):              # 0x01
+    mln: int
+    dest: int
+    command: int
+    sec_source: int
+    link: int
+
+class SourceStatus(NamedTuple):             # 0x02
+    mln: int
+    source: int
+    medium_position: int
+    position: int
+    activity: int
+    picture_format: int
+
+class PictSndStatus(NamedTuple):            # 0x03
+    mln: int
+    sound_status: int
+    speaker_mode: int
+    volume: int
+    screen1_mute: int
+    screen1_active: int
+    screen2_mute: int
+    screen2_active: int
+    cinema_mode: int
+    stereo: int
+
+class LightControl(NamedTuple):             # 0x04
+    room: int
+    type: int
+    command: int
+
+class AllStandby(NamedTuple):               # 0x05
+    pass
+
+class BeoRemoteOneCommand(NamedTuple):      # 0x06
+    mln: int
+    command: int
+    payload: bytes
+
+class BeoRemoteOneSource(NamedTuple):       # 0x07
+    mln: int
+    source: int
+    payload: bytes
+
+class VirtualButton(NamedTuple):            # 0x20
+    button: int
+    action: int
+
+class LoginRequest(NamedTuple):             # 0x30
+    user: str
+    password: str
+
+class LoginStatus(NamedTuple):              # 0x31
+    status: int
+
+class ChangePasswordRequest(NamedTuple):    # 0x32
+    payload: bytes
+
+class ChangePasswordResponse(NamedTuple):   # 0x33
+    payload: bytes
+
+class SecureLoginRequest(NamedTuple):       # 0x34
+    payload: bytes
+
+class Ping(NamedTuple):                     # 0x36
+    pass
+
+class Pong(NamedTuple):                     # 0x37
+    pass
+
+class ConfigurationChange(NamedTuple):      # 0x38
+    payload: bytes
+
+class RequestSerialNumber(NamedTuple):      # 0x39
+    pass
+
+class SerialNumber(NamedTuple):             # 0x3a
+    serial: str
+
+class LocationEvent(NamedTuple):            # 0x40
+    payload: bytes
+
+class UnknownTelegram(NamedTuple):          # anything else, or a malformed telegram
+    msg_type: int
+    payload: bytes
+
+
+_BEO4_CMD_PAYLOAD = struct.Struct("5B")
+_SOURCE_STATUS_PAYLOAD = struct.Struct(">BBHHBB")
+_PICTSND_STATUS_PAYLOAD = struct.Struct("10B")
+_LIGHT_CONTROL_PAYLOAD = struct.Struct("3B")
+
+def _payload( telegram ):
+    return bytes(telegram[4:4+telegram[2]])
+
+def _decode_virtual_btn( telegram ):
+    # older gateways send the button number only, which is a press
+    return VirtualButton(telegram[4], telegram[5] if telegram[2] > 1 else 0x01)
+
+def _decode_login_request( telegram ):
+    user, _, password = _payload(telegram).partition(b"\x00")
+    return LoginRequest(str(user, 'utf-8'), str(password, 'utf-8'))
+
+_DECODERS = {
+    0x01: lambda t: Beo4Command._make(_BEO4_CMD_PAYLOAD.unpack_from(t, HEADER_SIZE)),
+    0x02: lambda t: SourceStatus._make(_SOURCE_STATUS_PAYLOAD.unpack_from(t, HEADER_SIZE)),
+    0x03: lambda t: PictSndStatus._make(_PICTSND_STATUS_PAYLOAD.unpack_from(t, HEADER_SIZE)),
+    0x04: lambda t: LightControl._make(_LIGHT_CONTROL_PAYLOAD.unpack_from(t, HEADER_SIZE)),
+    0x05: lambda t: AllStandby(),
+    0x06: lambda t: BeoRemoteOneCommand(t[4], t[5], _payload(t)),
+    0x07: lambda t: BeoRemoteOneSource(t[4], t[5], _payload(t)),
+    0x20: _decode_virtual_btn,
+    0x30: _decode_login_request,
+    0x31: lambda t: LoginStatus(t[4]),
+    0x32: lambda t: ChangePasswordRequest(_payload(t)),
+    0x33: lambda t: ChangePasswordResponse(_payload(t)),
+    0x34: lambda t: SecureLoginRequest(_payload(t)),
+    0x36: lambda t: Ping(),
+    0x37: lambda t: Pong(),
+    0x38: lambda t: ConfigurationChange(_payload(t)),
+    0x39: lambda t: RequestSerialNumber(),
+    0x3a: lambda t: SerialNumber(str(t[4:4+t[2]], 'utf-8')),
+    0x40: lambda t: LocationEvent(_payload(t)),
+}
+
+## Decode a raw telegram into its message class
+#
+#   Unknown and malformed telegrams are returned as UnknownTelegram.
+#
+def decode( telegram ):
+    decoder = _DECODERS.get(telegram[1])
+    if decoder is not None:
+        try:
+            return decoder(telegram)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            pass
+    return UnknownTelegram(telegram[1], _payload(telegram))
+
+
+"""
+TelegramStr defers decoding a telegram until it is converted to a string. Pass it as a logging argument, e.g.
+_LOGGER.debug("Payload: %s", TelegramStr(telegram)), and the telegram is only decoded if the record is emitted.
+
+"""
+class TelegramStr:
+    __slots__ = ('_telegram',)
+
+    def __init__(self, telegram):
+        self._telegram = telegram
+
+    def __str__(self):
+        return _getpayloadstr(self._telegram)
+
+
+"""
+TelegramFramer splits the byte stream received from the gateway into telegrams, using the length byte in the header.
+
+Data is read straight into a reusable receive buffer (get_buffer / buffer_updated, as used by asyncio.BufferedProtocol).
+Iterating the framer yields every complete telegram as a memoryview into that buffer, without copying. A telegram
+is only valid until the next call to get_buffer(); incomplete telegrams are kept for the next read.
+
+"""
+class TelegramFramer:
+    def __init__(self, size=4096):
+        if size < 2 * MAX_TELEGRAM_SIZE:
+            raise ValueError("Receive buffer must hold at least two telegrams")
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.discarded = 0  # bytes skipped to get back in sync with the SOH byte
+
+    ## Return the free part of the receive buffer
+    def get_buffer(self, sizehint=-1):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < MAX_TELEGRAM_SIZE:
+            # move the incomplete telegram to the front to make room for a full one
+            pending = self._end - self._start
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        return self._view[self._end:]
+
+    ## Account for nbytes written into the buffer returned by get_buffer()
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    ## Copy data into the receive buffer and yield the complete telegrams
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            buf = self.get_buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            self.buffer_updated(n)
+            data = data[n:]
+            yield from self
+
+    def __iter__(self):
+        buf = self._buffer
+        while self._end - self._start >= HEADER_SIZE:
+            start = self._start
+            if buf[start] != SOH:
+                nxt = buf.find(SOH, start + 1, self._end)
+                if nxt < 0:
+                    nxt = self._end
+                self.discarded += nxt - start
+                self._start = nxt
+                continue
+            end = start + HEADER_SIZE + buf[start + 2]
+            if end > self._end:
+                break
+            self._start = end
+            yield self._view[start:end]
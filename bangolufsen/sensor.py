@@ -0,0 +1,130 @@
+"""
+Diagnostic sensors for a Masterlink Gateway connection.
+
+The media_player platform loads this platform for every gateway it sets up. The sensors read the gateway's metrics
+snapshot when they are polled, so the gateway itself only keeps counters. They update on the event loop, which is
+where the gateway changes its counters, and the sensors of a gateway share one snapshot per poll.
+
+"""
+import time
+from datetime import timedelta
+from typing import NamedTuple, Optional
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.helpers.entity import EntityCategory
+
+from . import DATA_GATEWAYS, DOMAIN
+from .media_player import _EventDispatcher
+
+SCAN_INTERVAL = timedelta(seconds=30)
+# The sensors of a gateway are polled together: a snapshot younger than this is from the same poll
+SNAPSHOT_MAX_AGE = 1
+
+
+class _MetricDescription(NamedTuple):
+    key: str
+    name: str
+    unit: Optional[str]
+    state_class: Optional[str]
+    attributes: Optional[str] = None     # snapshot key shown as the attributes
+
+
+SENSORS = (
+    _MetricDescription('telegrams_received_total', 'telegrams received', 'telegrams',
+                       SensorStateClass.TOTAL_INCREASING, 'telegrams_received'),
+    _MetricDescription('telegrams_sent_total', 'telegrams sent', 'telegrams',
+                       SensorStateClass.TOTAL_INCREASING, 'telegrams_sent'),
+    _MetricDescription('bytes_in', 'bytes received', 'B', SensorStateClass.TOTAL_INCREASING),
+    _MetricDescription('bytes_out', 'bytes sent', 'B', SensorStateClass.TOTAL_INCREASING),
+    _MetricDescription('queue_depth', 'command queue', 'commands', SensorStateClass.MEASUREMENT),
+    _MetricDescription('ingest_queue_depth', 'receive queue', 'telegrams', SensorStateClass.MEASUREMENT),
+    _MetricDescription('ingest_dropped', 'telegrams dropped', 'telegrams', SensorStateClass.TOTAL_INCREASING,
+                       'ingest_dropped_by_type'),
+    _MetricDescription('reconnects', 'reconnects', None, SensorStateClass.TOTAL_INCREASING),
+    _MetricDescription('ping_rtt_ms', 'ping round trip', 'ms', SensorStateClass.MEASUREMENT),
+    _MetricDescription('events_per_second', 'events per second', 'events/s', SensorStateClass.MEASUREMENT,
+                       'events_per_second'),
+)
+
+# echo latency sensors: payload type name in the snapshot, key, name
+ECHO_SENSORS = (
+    ('Source Status', 'source_status', 'source status echo'),
+    ('Pict&Snd Status', 'pictsnd_status', 'picture and sound status echo'),
+)
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    if discovery_info is None:
+        return
+    gateway_id = discovery_info['gateway']
+    snapshots = _Snapshots(hass.data[DOMAIN][DATA_GATEWAYS][gateway_id])
+    sensors = [GatewayMetricSensor(snapshots, gateway_id, description) for description in SENSORS]
+    sensors += [EchoLatencySensor(snapshots, gateway_id, *echo) for echo in ECHO_SENSORS]
+    async_add_entities(sensors, True)
+
+
+"""
+_Snapshots hands out the metrics snapshot of a gateway, taking a new one at most once per poll.
+
+"""
+class _Snapshots:
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._snapshot = None
+        self._taken = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if self._snapshot is None or now - self._taken >= SNAPSHOT_MAX_AGE:
+            self._snapshot = self._gateway.metrics_snapshot()
+            self._taken = now
+        return self._snapshot
+
+
+"""
+GatewayMetricSensor shows one value of MLGateway.metrics_snapshot().
+
+"""
+class GatewayMetricSensor(SensorEntity):
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, snapshots, gateway_id, description):
+        self._snapshots = snapshots
+        self._description = description
+        self._attr_name = "mlgw %s %s" % (gateway_id, description.name)
+        self._attr_unique_id = "%s_%s_%s" % (DOMAIN, gateway_id, description.key)
+        self._attr_native_unit_of_measurement = description.unit
+        self._attr_state_class = description.state_class
+
+    async def async_update(self):
+        snapshot = self._snapshots.get()
+        value = snapshot.get(self._description.key)
+        if isinstance(value, dict):
+            # events per second, by event type. The suppressed hold repeats were not fired, and are only shown in
+            # the attributes.
+            value = sum(count for event_type, count in value.items() if event_type != _EventDispatcher.SUPPRESSED)
+        self._attr_native_value = value
+        if self._description.attributes is not None:
+            self._attr_extra_state_attributes = snapshot[self._description.attributes]
+
+
+"""
+EchoLatencySensor shows the mean time from a Beo4 command to the status telegram the product sends back, with the
+latency histogram as attributes.
+
+"""
+class EchoLatencySensor(SensorEntity):
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_native_unit_of_measurement = 'ms'
+    _attr_state_class = SensorStateClass.MEASUREMENT
+
+    def __init__(self, snapshots, gateway_id, payload_type, key, name):
+        self._snapshots = snapshots
+        self._payload_type = payload_type
+        self._attr_name = "mlgw %s %s" % (gateway_id, name)
+        self._attr_unique_id = "%s_%s_echo_%s" % (DOMAIN, gateway_id, key)
+
+    async def async_update(self):
+        histogram = self._snapshots.get()['echo_latency'][self._payload_type]
+        self._attr_native_value = histogram['mean_ms']
+        self._attr_extra_state_attributes = histogram
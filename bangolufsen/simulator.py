@@ -0,0 +1,347 @@
+"""
+Local stand-in for a Masterlink Gateway, for testing and load generation.
+
+SimulatedGateway is an asyncio TCP server speaking the MLGW telegram protocol: Login (FAIL / OK), Ping / Pong, Serial
+Number, Beo4 commands echoed as Source Status (and Picture & Sound Status for volume and mute), and scripted bursts of
+Picture & Sound Status, Light/Control, All Standby and virtual button telegrams. Replies can be delayed, split into
+fragments and coalesced into a single write, to reproduce what a real network does to the telegram stream.
+
+Run it from the repository root, and point the platform at it:
+
+    python -m bangolufsen.simulator --port 9000 --split 3 --burst button:200 --burst-every 5
+
+"""
+import argparse
+import asyncio
+import logging
+import random
+import socket
+
+from .mlgw import (
+    BEO4_CMDS,
+    TelegramFramer,
+    decode,
+    encode_telegram,
+    reverse_destselectordict,
+    reverse_selectedsourcedict,
+    beo4commanddict,
+    virtualactiondict,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Beo4 source selection command -> the source code reported in Source Status
+_SOURCE_FOR_COMMAND = {
+    BEO4_CMDS[name]: code for name, code in reverse_selectedsourcedict.items() if name in BEO4_CMDS
+}
+_ALL_PRODUCTS = reverse_destselectordict['ALL PRODUCTS']
+_ACTIVITY_PLAYING = 0x02
+_ACTIVITY_STANDBY = 0x06
+_VIRTUAL_ACTIONS = {v: k for k, v in virtualactiondict.items()}
+MAX_VOLUME = 90
+
+
+# ########################################################################################
+# ##### Telegrams sent by the gateway
+
+def encode_source_status( mln, source, activity=_ACTIVITY_PLAYING, medium_position=0, position=1, picture_format=0 ):
+    return encode_telegram(0x02, bytes((
+        mln, source, medium_position >> 8, medium_position & 0xff, position >> 8, position & 0xff,
+        activity, picture_format, 0x00, 0x00)))
+
+def encode_pictsnd_status( mln, volume, muted=False, speaker_mode=0x02, stereo=True ):
+    return encode_telegram(0x03, bytes((
+        mln, 0x01 if muted else 0x00, speaker_mode, volume, 0x00, 0x00, 0x00, 0x00, 0x00, 0x01 if stereo else 0x00)))
+
+def encode_light_control( room, lctype, command ):
+    return encode_telegram(0x04, bytes((room, lctype, command)))
+
+def encode_virtual_btn_event( button, action ):
+    return encode_telegram(0x20, bytes((button, action)))
+
+ALL_STANDBY_TELEGRAM = encode_telegram(0x05)
+PONG_TELEGRAM = encode_telegram(0x37)
+
+
+## Telegrams for a scripted burst of one kind: pictsnd, lightcontrol, allstandby or button
+def burst_telegrams( kind, count, mln=1 ):
+    if kind == 'pictsnd':
+        return [encode_pictsnd_status(mln, i % (MAX_VOLUME + 1)) for i in range(count)]
+    if kind == 'lightcontrol':
+        # a held LIGHT key: the same command repeated, then a key release
+        command = BEO4_CMDS['VOLUME UP']
+        return [encode_light_control(mln, 0x01, command) for _ in range(count - 1)] + \
+            [encode_light_control(mln, 0x01, BEO4_CMDS['KEY RELEASE'])]
+    if kind == 'allstandby':
+        return [ALL_STANDBY_TELEGRAM] * count
+    if kind == 'button':
+        # a held virtual button: press, hold repeats, release
+        actions = [_VIRTUAL_ACTIONS['PRESS']] + [_VIRTUAL_ACTIONS['HOLD']] * max(count - 2, 0) + \
+            [_VIRTUAL_ACTIONS['RELEASE']]
+        return [encode_virtual_btn_event(mln, action) for action in actions[:count]]
+    raise ValueError("Unknown burst kind %r" % kind)
+
+
+"""
+_DeviceState is what the simulator knows about one Masterlink product.
+
+"""
+class _DeviceState:
+    __slots__ = ('source', 'on', 'volume', 'muted')
+
+    def __init__(self):
+        self.source = reverse_selectedsourcedict['A.MEM']
+        self.on = False
+        self.volume = 30
+        self.muted = False
+
+
+"""
+SimulatedGateway serves any number of clients. Each client must log in first if require_login is set.
+
+latency     seconds before a reply is written
+split       if set, every write is cut into random fragments of at most this many bytes
+coalesce    seconds to collect telegrams before writing them all at once
+
+"""
+class SimulatedGateway:
+    def __init__(self, host='127.0.0.1', port=9000, user='admin', password='admin', serial='SIM00001',
+                 require_login=True, latency=0.0, split=0, coalesce=0.0):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.serial = serial
+        self.require_login = require_login
+        self.latency = latency
+        self.split = split
+        self.coalesce = coalesce
+        self.devices = {}
+        self.received = []      # decoded telegrams received from all clients, in order
+        self._clients = set()
+        self._client_tasks = set()
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        sock = self._server.sockets[0]
+        self.port = sock.getsockname()[1]
+        _LOGGER.info("Simulated ML Gateway listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        for client in list(self._clients):
+            client.close()
+        # let the client handlers see the connections close
+        if self._client_tasks:
+            await asyncio.wait(self._client_tasks)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    ## Send telegrams to every logged in client
+    def broadcast(self, telegrams):
+        for client in self._clients:
+            if client.logged_in:
+                client.send(telegrams)
+
+    ## Send count telegrams of one kind to every client, interval seconds apart (0: all in one go)
+    async def burst(self, kind, count, interval=0.0, mln=1):
+        telegrams = burst_telegrams(kind, count, mln)
+        if interval <= 0:
+            self.broadcast(telegrams)
+            return
+        for telegram in telegrams:
+            self.broadcast([telegram])
+            await asyncio.sleep(interval)
+
+    def _device(self, mln):
+        device = self.devices.get(mln)
+        if device is None:
+            device = self.devices[mln] = _DeviceState()
+        return device
+
+    async def _handle_client(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and self.split:
+            # write fragments as separate segments
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        task = asyncio.current_task()
+        self._client_tasks.add(task)
+        client = _SimulatedClient(self, writer)
+        self._clients.add(client)
+        if self.require_login:
+            client.send([encode_telegram(0x31, b"\x01")])     # Login status FAIL
+        else:
+            client.logged_in = True
+        framer = TelegramFramer()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                for telegram in framer.feed(data):
+                    self._handle_telegram(client, telegram)
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(client)
+            self._client_tasks.discard(task)
+            client.close()
+
+    def _handle_telegram(self, client, telegram):
+        msg = decode(telegram)
+        self.received.append(msg)
+        msg_type = telegram[1]
+
+        if msg_type == 0x30:            # Login request
+            client.logged_in = (msg.user, msg.password) == (self.user, self.password)
+            client.send([encode_telegram(0x31, b"\x00" if client.logged_in else b"\x01")])
+        elif msg_type == 0x36:          # Ping
+            client.send([PONG_TELEGRAM])
+        elif not client.logged_in:
+            client.send([encode_telegram(0x31, b"\x01")])
+        elif msg_type == 0x39:          # Request Serial Number
+            client.send([encode_telegram(0x3a, self.serial.encode('utf-8'))])
+        elif msg_type == 0x01:          # Beo4 Command
+            self.broadcast(self._beo4_command(msg))
+
+    ## Apply a Beo4 command to the simulated products, and return the status telegrams it causes
+    def _beo4_command(self, msg):
+        command = msg.command
+        if command == BEO4_CMDS['STANDBY']:
+            if msg.dest == _ALL_PRODUCTS:
+                for device in self.devices.values():
+                    device.on = False
+                return [ALL_STANDBY_TELEGRAM]
+            device = self._device(msg.mln)
+            device.on = False
+            return [encode_source_status(msg.mln, device.source, _ACTIVITY_STANDBY)]
+
+        if command in _SOURCE_FOR_COMMAND:
+            mlns = self.devices if msg.dest == _ALL_PRODUCTS else (msg.mln,)
+            telegrams = []
+            for mln in list(mlns):
+                device = self._device(mln)
+                device.source = _SOURCE_FOR_COMMAND[command]
+                device.on = True
+                telegrams.append(encode_source_status(mln, device.source))
+            return telegrams
+
+        device = self._device(msg.mln)
+        if command == BEO4_CMDS['VOLUME UP']:
+            device.volume = min(device.volume + 1, MAX_VOLUME)
+        elif command == BEO4_CMDS['VOLUME DOWN']:
+            device.volume = max(device.volume - 1, 0)
+        elif command == BEO4_CMDS['MUTE']:
+            device.muted = not device.muted
+        else:
+            _LOGGER.debug("Ignoring Beo4 command %s", beo4commanddict.get(command, command))
+            return []
+        return [encode_pictsnd_status(msg.mln, device.volume, device.muted)]
+
+
+"""
+_SimulatedClient shapes the telegrams written to one client: latency, fragmentation and coalescing.
+
+"""
+class _SimulatedClient:
+    def __init__(self, gateway, writer):
+        self._gateway = gateway
+        self._writer = writer
+        self._pending = []
+        self._flush_handle = None
+        self._fragments = bytearray()
+        self._fragment_task = None
+        self.logged_in = False
+
+    def send(self, telegrams):
+        self._pending.extend(telegrams)
+        if self._flush_handle is None:
+            delay = self._gateway.latency + self._gateway.coalesce
+            loop = asyncio.get_running_loop()
+            if delay > 0:
+                self._flush_handle = loop.call_later(delay, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if self._writer.is_closing():
+            return
+        if self._gateway.coalesce > 0:
+            chunks = [b"".join(self._pending)]
+        else:
+            chunks = list(self._pending)
+        self._pending.clear()
+        if self._gateway.split:
+            # one fragment writer per client, so fragments of different writes never interleave
+            self._fragments += b"".join(chunks)
+            if self._fragment_task is None or self._fragment_task.done():
+                self._fragment_task = asyncio.get_running_loop().create_task(self._write_fragments())
+        else:
+            for chunk in chunks:
+                self._writer.write(chunk)
+
+    async def _write_fragments(self):
+        while self._fragments and not self._writer.is_closing():
+            n = random.randint(1, self._gateway.split)
+            self._writer.write(bytes(self._fragments[:n]))
+            del self._fragments[:n]
+            try:
+                await self._writer.drain()
+            except ConnectionError:
+                return
+            # give the fragment a chance to go out on its own
+            await asyncio.sleep(0)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._fragment_task is not None:
+            self._fragment_task.cancel()
+        self._writer.close()
+
+
+async def _run(args):
+    gateway = SimulatedGateway(args.host, args.port, args.username, args.password, args.serial,
+                               not args.no_login, args.latency / 1000, args.split, args.coalesce / 1000)
+    await gateway.start()
+    bursts = []
+    for burst in args.burst:
+        kind, _, count = burst.partition(':')
+        bursts.append((kind, int(count or 100)))
+    try:
+        while True:
+            await asyncio.sleep(args.burst_every if bursts else 3600)
+            for kind, count in bursts:
+                _LOGGER.info("Sending a burst of %d %s telegrams", count, kind)
+                await gateway.burst(kind, count, args.burst_interval / 1000)
+    finally:
+        await gateway.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated Masterlink Gateway")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--serial', default='SIM00001')
+    parser.add_argument('--no-login', action='store_true', help="accept commands without a login")
+    parser.add_argument('--latency', type=float, default=0, help="reply latency in ms")
+    parser.add_argument('--split', type=int, default=0, help="cut writes into fragments of at most this many bytes")
+    parser.add_argument('--coalesce', type=float, default=0, help="collect telegrams for this many ms per write")
+    parser.add_argument('--burst', action='append', default=[],
+                        help="KIND:COUNT, KIND is one of pictsnd, lightcontrol, allstandby, button")
+    parser.add_argument('--burst-every', type=float, default=10, help="seconds between bursts")
+    parser.add_argument('--burst-interval', type=float, default=0, help="ms between telegrams in a burst")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(_run(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+"""
+Subscriptions to Light/Control commands and virtual button events.
+
+Every Light/Control and virtual button telegram is still fired on the Home Assistant bus. Subscribers registered here
+are indexed by (room, type, command) and (button, action) instead, so a telegram only calls the subscribers that
+match it, however many there are. A field left as None matches any value. Text fields match regardless of case.
+
+    unsubscribe = get_subscriptions(hass).subscribe_light_control(callback, room=3, command='Volume UP')
+
+The callback is called on the event loop with the event data, the same dict that is fired on the bus.
+
+"""
+import logging
+from collections import Counter
+
+from . import DATA_SUBSCRIPTIONS, DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+
+## The subscriptions of this Home Assistant instance, shared by all the gateways
+def get_subscriptions(hass):
+    return hass.data.setdefault(DOMAIN, {}).setdefault(DATA_SUBSCRIPTIONS, EventSubscriptions())
+
+
+def _normalize(value):
+    return value.upper() if isinstance(value, str) else value
+
+
+"""
+_SubscriptionIndex maps keys of a fixed number of fields to callbacks. Besides the subscribers, it counts which
+fields are wildcards in the keys in use, so a lookup costs one dict access per wildcard pattern in use, not one per
+subscriber.
+
+"""
+class _SubscriptionIndex:
+    def __init__(self):
+        self._subscribers = {}
+        self._patterns = Counter()
+
+    def __len__(self):
+        return sum(self._patterns.values())
+
+    def add(self, key, callback):
+        key = tuple(_normalize(value) for value in key)
+        pattern = tuple(value is not None for value in key)
+        self._subscribers.setdefault(key, []).append(callback)
+        self._patterns[pattern] += 1
+
+        def remove():
+            callbacks = self._subscribers.get(key)
+            if callbacks is None or callback not in callbacks:
+                return
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._subscribers[key]
+            self._patterns[pattern] -= 1
+            if not self._patterns[pattern]:
+                del self._patterns[pattern]
+        return remove
+
+    def dispatch(self, values, data):
+        if not self._patterns:
+            return
+        values = tuple(_normalize(value) for value in values)
+        for pattern in tuple(self._patterns):
+            key = tuple(value if used else None for value, used in zip(values, pattern))
+            for callback in tuple(self._subscribers.get(key, ())):
+                try:
+                    callback(data)
+                except Exception:   # one broken subscriber must not starve the others
+                    _LOGGER.exception("Error in subscriber for %s", data)
+
+
+class EventSubscriptions:
+    def __init__(self):
+        self._light_control = _SubscriptionIndex()
+        self._virtual_button = _SubscriptionIndex()
+
+    ## Call callback(data) for matching Light/Control commands. Returns a function that unsubscribes.
+    def subscribe_light_control(self, callback, room=None, lctype=None, command=None):
+        return self._light_control.add((room, lctype, command), callback)
+
+    ## Call callback(data) for matching virtual button events. Returns a function that unsubscribes.
+    def subscribe_virtual_button(self, callback, button=None, action=None):
+        return self._virtual_button.add((button, action), callback)
+
+    def light_control(self, data):
+        self._light_control.dispatch((data["room"], data["type"], data["command"]), data)
+
+    def virtual_button(self, data):
+        self._virtual_button.dispatch((data["button"], data["action"]), data)
+
+    @property
+    def subscriber_count(self):
+        return len(self._light_control) + len(self._virtual_button)
@@ -0,0 +1,85 @@
+"""
+Automation triggers for Light/Control commands and virtual button events.
+
+The triggers are served from the subscription index (see subscriptions.py), so a telegram only runs the automations
+it matches:
+
+automation:
+  trigger:
+    platform: bangolufsen
+    type: light_control
+    room: 3
+    command: Volume UP
+
+  trigger:
+    platform: bangolufsen
+    type: virtual_button
+    button: 12
+    action: PRESS
+
+Fields that are left out match anything. The trigger variables hold the fields of the event; the Light/Control type
+(LIGHT or CONTROL) is trigger.lc_type, as trigger.type is the trigger type.
+
+"""
+import voluptuous as vol
+
+from homeassistant.const import CONF_PLATFORM, CONF_TYPE
+from homeassistant.core import HassJob, callback
+import homeassistant.helpers.config_validation as cv
+
+from . import DOMAIN
+from .subscriptions import get_subscriptions
+
+TRIGGER_LIGHT_CONTROL = 'light_control'
+TRIGGER_VIRTUAL_BUTTON = 'virtual_button'
+CONF_ROOM = 'room'
+CONF_LC_TYPE = 'lc_type'
+CONF_COMMAND = 'command'
+CONF_BUTTON = 'button'
+CONF_ACTION = 'action'
+
+TRIGGER_SCHEMA = vol.Any(
+    cv.TRIGGER_BASE_SCHEMA.extend({
+        vol.Required(CONF_PLATFORM): DOMAIN,
+        vol.Required(CONF_TYPE): TRIGGER_LIGHT_CONTROL,
+        vol.Optional(CONF_ROOM): vol.All(vol.Coerce(int), vol.Range(min=0, max=255)),
+        vol.Optional(CONF_LC_TYPE): cv.string,
+        vol.Optional(CONF_COMMAND): cv.string,
+    }),
+    cv.TRIGGER_BASE_SCHEMA.extend({
+        vol.Required(CONF_PLATFORM): DOMAIN,
+        vol.Required(CONF_TYPE): TRIGGER_VIRTUAL_BUTTON,
+        vol.Optional(CONF_BUTTON): vol.All(vol.Coerce(int), vol.Range(min=0, max=255)),
+        vol.Optional(CONF_ACTION): vol.All(vol.Upper, vol.In(['PRESS', 'HOLD', 'RELEASE'])),
+    }),
+)
+
+
+async def async_validate_trigger_config(hass, config):
+    return TRIGGER_SCHEMA(config)
+
+
+async def async_attach_trigger(hass, config, action, trigger_info):
+    trigger_data = trigger_info["trigger_data"]
+    trigger_type = config[CONF_TYPE]
+    job = HassJob(action)
+
+    @callback
+    def _handle(data):
+        # the Light/Control type would be hidden by the trigger type
+        data = {CONF_LC_TYPE if key == CONF_TYPE else key: value for key, value in data.items()}
+        hass.async_run_hass_job(job, {
+            "trigger": {
+                **trigger_data,
+                **data,
+                "platform": DOMAIN,
+                "type": trigger_type,
+                "description": "%s %s" % (DOMAIN, trigger_type.replace('_', ' ')),
+            }
+        })
+
+    subscriptions = get_subscriptions(hass)
+    if trigger_type == TRIGGER_LIGHT_CONTROL:
+        return subscriptions.subscribe_light_control(
+            _handle, config.get(CONF_ROOM), config.get(CONF_LC_TYPE), config.get(CONF_COMMAND))
+    return subscriptions.subscribe_virtual_button(_handle, config.get(CONF_BUTTON), config.get(CONF_ACTION))
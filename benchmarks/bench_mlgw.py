@@ -0,0 +1,414 @@
+"""
+Benchmarks for the Masterlink Gateway component.
+
+Four parts, each of which can be run on its own:
+
+codec       encode and decode throughput per telegram type, the cost of the debug log string, and batch decoding
+command     latency from BeoSpeaker.async_select_source to the command arriving at the gateway, and of a MUTE sent
+            while a volume burst is being written
+listener    throughput and drop rate of the listener under a flood of events from the gateway
+memory      memory per connected device
+
+The command, listener and memory parts run MLGateway against the local simulator (bangolufsen/simulator.py), so
+they need Home Assistant installed, like the component itself. No Home Assistant instance is started: the devices
+are not added to a state machine, and events fired on the bus are only counted.
+
+Results are written as JSON so that runs can be compared:
+
+    python benchmarks/bench_mlgw.py --output before.json
+    python benchmarks/bench_mlgw.py --output after.json --compare before.json
+
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bangolufsen import batch   # noqa: E402
+from bangolufsen.mlgw import (   # noqa: E402
+    BEO4_CMDS,
+    TelegramFramer,
+    TelegramStr,
+    decode,
+    encode_beo4_cmd,
+    encode_login,
+    encode_telegram,
+    encode_virtual_btn_press,
+    reverse_destselectordict,
+)
+from bangolufsen.simulator import (   # noqa: E402
+    ALL_STANDBY_TELEGRAM,
+    SimulatedGateway,
+    encode_light_control,
+    encode_pictsnd_status,
+    encode_source_status,
+    encode_virtual_btn_event,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+SOURCES = ['A.MEM', 'CD', 'RADIO', 'N.RADIO', 'N.MUSIC']
+
+
+## Run a callable in batches until min_time has passed, and return calls per second of the best batch
+def _rate( func, min_time ):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = 0.0
+    deadline = time.perf_counter() + min_time
+    while True:
+        best = max(best, number / timer.timeit(number))
+        if time.perf_counter() >= deadline:
+            return best
+
+
+def _percentiles( samples ):
+    samples = sorted(samples)
+    def pick(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': samples[-1],
+        'mean': statistics.fmean(samples),
+    }
+
+
+def bench_codec( min_time ):
+    dest = reverse_destselectordict['AUDIO SOURCE']
+    cd = BEO4_CMDS['CD']
+    telegrams = {
+        'beo4_command': encode_beo4_cmd(1, dest, cd),
+        'source_status': encode_source_status(1, 0x92),
+        'pictsnd_status': encode_pictsnd_status(1, 30),
+        'light_control': encode_light_control(1, 0x01, cd),
+        'all_standby': ALL_STANDBY_TELEGRAM,
+        'virtual_button': encode_virtual_btn_event(1, 0x01),
+        'login_request': encode_login('admin', 'admin'),
+        'serial_number': encode_telegram(0x3a, b'SIM00001'),
+    }
+    encoders = {
+        # encode_beo4_cmd and encode_virtual_btn_press are cached, encode_telegram is the uncached path
+        'beo4_command': lambda: encode_beo4_cmd(1, dest, cd),
+        'beo4_command_uncached': lambda: encode_beo4_cmd.__wrapped__(1, dest, cd),
+        'virtual_button_press': lambda: encode_virtual_btn_press(1),
+        'login_request': lambda: encode_login('admin', 'admin'),
+        'telegram': lambda: encode_telegram(0x05),
+    }
+
+    results = {'encode': {}, 'decode': {}, 'log_string': {}, 'framing': {}}
+    for name, encoder in encoders.items():
+        results['encode'][name] = _rate(encoder, min_time)
+    for name, telegram in telegrams.items():
+        view = memoryview(telegram)
+        results['decode'][name] = _rate(lambda: decode(view), min_time)
+        results['log_string'][name] = _rate(lambda: str(TelegramStr(view)), min_time)
+
+    # a stream of mixed telegrams, fed in 1 kB reads
+    stream = b''.join(telegrams.values()) * 64
+    chunks = [stream[i:i + 1024] for i in range(0, len(stream), 1024)]
+    def frame():
+        framer = TelegramFramer()
+        for chunk in chunks:
+            for _ in framer.feed(chunk):
+                pass
+    results['framing']['telegrams_per_second'] = _rate(frame, min_time) * len(telegrams) * 64
+
+    # the same stream, decoded to columns in one call
+    big_stream = stream * 64
+    results['batch'] = {
+        'numpy': batch.np is not None,
+        'telegrams_per_second': _rate(lambda: batch.decode_batch(big_stream), min_time) * len(telegrams) * 64 * 64,
+    }
+    return results
+
+
+"""
+_BenchHass is the part of Home Assistant that MLGateway uses: the bus and task creation. Fired events are counted.
+
+"""
+class _BenchHass:
+    def __init__(self):
+        self.data = {}
+        self.bus = _BenchBus()
+        self.loop = asyncio.get_running_loop()
+
+    def async_create_task(self, coro):
+        return self.loop.create_task(coro)
+
+
+class _BenchBus:
+    def __init__(self):
+        self.fired = Counter()
+        self._listeners = {}
+
+    def async_fire(self, event_type, event_data=None):
+        self.fired[event_type] += 1
+
+    def async_listen_once(self, event_type, listener):
+        self._listeners.setdefault(event_type, []).append(listener)
+
+    def fire_stop(self):
+        for listener in self._listeners.pop('homeassistant_stop', []):
+            listener(None)
+
+
+"""
+_TimedGateway is the simulator, recording when each Beo4 command arrives, and which command it is.
+
+"""
+class _TimedGateway(SimulatedGateway):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.command_times = []
+        self.commands = []
+        self.command_received = asyncio.Event()
+
+    def _handle_telegram(self, client, telegram):
+        if telegram[1] == 0x01:
+            self.command_times.append(time.perf_counter())
+            self.commands.append(telegram[6])
+            self.command_received.set()
+        super()._handle_telegram(client, telegram)
+
+
+async def _setup( gateway, devices, send_delay, coalesce_hold=False ):
+    from bangolufsen import media_player
+
+    # what async_setup_platform does, without the sensor platform
+    hass = _BenchHass()
+    mlgw = media_player.MLGateway(gateway.host, gateway.port, gateway.user, gateway.password, SOURCES[0], SOURCES,
+                                  hass, send_delay, coalesce_hold)
+    hass.bus.async_listen_once('homeassistant_stop', lambda _event: mlgw.stop())
+    entities = [media_player.BeoSpeaker(i + 1, 'speaker%d' % (i + 1), mlgw) for i in range(devices)]
+    mlgw.set_devices(entities)
+    mlgw.start()
+    deadline = time.perf_counter() + 10
+    while not (entities[0].available and entities[0]._gateway.serial):
+        if time.perf_counter() > deadline:
+            raise RuntimeError("Could not connect to the simulated gateway")
+        await asyncio.sleep(0.01)
+    return hass, entities
+
+
+async def bench_command( commands, send_delay, latency ):
+    gateway = _TimedGateway(port=0, latency=latency)
+    await gateway.start()
+    hass, entities = await _setup(gateway, 1, send_delay)
+    speaker = entities[0]
+    try:
+        samples = []
+        for i in range(commands):
+            gateway.command_received.clear()
+            start = time.perf_counter()
+            await speaker.async_select_source(SOURCES[i % len(SOURCES)])
+            await asyncio.wait_for(gateway.command_received.wait(), 5)
+            samples.append((gateway.command_times[-1] - start) * 1000)
+            # wait out the send delay, so every command measures an idle path
+            await asyncio.sleep(send_delay / 1000 + 0.005)
+        mute = await _mute_behind_burst(gateway, speaker)
+    finally:
+        hass.bus.fire_stop()
+        await gateway.stop()
+    return {'send_delay_ms': send_delay, 'reply_latency_ms': latency * 1000, 'latency_ms': _percentiles(samples),
+            'mute_in_burst': mute}
+
+
+## Set the volume from 31 to 85 and press MUTE 0.1 s later: the MUTE must not wait for the rest of the burst
+async def _mute_behind_burst( gateway, speaker ):
+    # the volume is known once the product has reported it
+    await speaker.async_volume_up()
+    await asyncio.sleep(0.2)
+    await speaker.async_set_volume_level(31 / 90)
+    await asyncio.sleep(2)
+    if speaker.volume_level is None or round(speaker.volume_level * 90) != 31:
+        raise RuntimeError("The volume did not reach 31")
+    await speaker.async_set_volume_level(85 / 90)
+    await asyncio.sleep(0.1)
+    sent = len(gateway.commands)
+    start = time.perf_counter()
+    await speaker.async_mute_volume(True)
+    deadline = start + 5
+    while BEO4_CMDS['MUTE'] not in gateway.commands[sent:]:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("MUTE did not arrive")
+        await asyncio.sleep(0.001)
+    at = gateway.commands.index(BEO4_CMDS['MUTE'], sent)
+    result = {'latency_ms': (gateway.command_times[at] - start) * 1000, 'steps_before': at - sent}
+    await asyncio.sleep(0.5)
+    result['steps_after'] = len(gateway.commands) - at - 1
+    return result
+
+
+async def bench_listener( count, split, coalesce, coalesce_hold ):
+    gateway = SimulatedGateway(port=0, split=split, coalesce=coalesce)
+    await gateway.start()
+    hass, entities = await _setup(gateway, 2, 0, coalesce_hold)
+    speaker = entities[1]
+    results = {'split': split, 'coalesce_ms': coalesce * 1000, 'coalesce_hold': coalesce_hold}
+    try:
+        for kind, event_type in (('button', 'bangolufsen_virtual_button'),
+                                 ('lightcontrol', 'bangolufsen_light_control_event'),
+                                 ('pictsnd', None)):
+            fired_before = hass.bus.fired[event_type]
+            start = time.perf_counter()
+            await gateway.burst(kind, count, mln=speaker.mln)
+            expected_volume = ((count - 1) % 91) / 90
+            # done when the expected events are in, or when nothing arrived for a while
+            last_change, last_seen = time.perf_counter(), None
+            while True:
+                if event_type is None:
+                    seen = speaker.volume_level
+                    done = seen == expected_volume
+                else:
+                    seen = hass.bus.fired[event_type] - fired_before
+                    done = seen >= count
+                now = time.perf_counter()
+                if seen != last_seen:
+                    last_change, last_seen = now, seen
+                if done or now - last_change > 1:
+                    break
+                await asyncio.sleep(0.001)
+            elapsed = last_change - start
+            result = {'telegrams': count, 'seconds': elapsed, 'telegrams_per_second': count / elapsed if elapsed else None}
+            if event_type is not None:
+                events = hass.bus.fired[event_type] - fired_before
+                result['events'] = events
+                if not coalesce_hold:
+                    result['drop_rate'] = 1 - events / count
+            else:
+                result['final_state_correct'] = speaker.volume_level == expected_volume
+            results[kind] = result
+            await asyncio.sleep(0.1)
+    finally:
+        hass.bus.fire_stop()
+        await gateway.stop()
+    return results
+
+
+async def _connected_memory( devices ):
+    gateway = SimulatedGateway(port=0)
+    await gateway.start()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        hass, entities = await _setup(gateway, devices, 0)
+        for speaker in entities:
+            # give every device some state
+            await gateway.burst('pictsnd', 1, mln=speaker.mln)
+        await asyncio.sleep(0.2)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        hass.bus.fire_stop()
+        await gateway.stop()
+    return used
+
+
+async def bench_memory( device_counts ):
+    used = {}
+    for devices in device_counts:
+        used[devices] = await _connected_memory(devices)
+    low, high = min(device_counts), max(device_counts)
+    return {
+        'bytes_by_devices': {str(devices): size for devices, size in used.items()},
+        'bytes_per_device': (used[high] - used[low]) / (high - low) if high > low else None,
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+    }
+
+
+## Flatten nested results into {'part.key.subkey': number}
+def _flatten( results, prefix='' ):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def _compare( results, baseline ):
+    new, old = _flatten(results['results']), _flatten(baseline['results'])
+    for name in sorted(new.keys() & old.keys()):
+        if old[name]:
+            print("%-60s %14.4g %14.4g %+8.1f%%" % (name, old[name], new[name], (new[name] / old[name] - 1) * 100))
+
+
+async def _run( args ):
+    results = {}
+    if 'codec' in args.parts:
+        results['codec'] = bench_codec(args.min_time)
+    if 'command' in args.parts:
+        results['command'] = await bench_command(args.commands, args.send_delay, args.latency / 1000)
+    if 'listener' in args.parts:
+        results['listener'] = await bench_listener(args.events, args.split, args.coalesce / 1000, args.coalesce_hold)
+    if 'memory' in args.parts:
+        results['memory'] = await bench_memory(args.devices)
+    return results
+
+
+if __name__ == '__main__':
+    parts = ['codec', 'command', 'listener', 'memory']
+    parser = argparse.ArgumentParser(description="Masterlink Gateway component benchmarks")
+    parser.add_argument('parts', nargs='*', metavar='part', help="%s (default: all)" % ', '.join(parts))
+    parser.add_argument('--output', help="write the results to this JSON file (default: stdout)")
+    parser.add_argument('--compare', help="print the change against the results in this JSON file")
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds per codec measurement")
+    parser.add_argument('--commands', type=int, default=200, help="commands to time")
+    parser.add_argument('--send-delay', type=int, default=50, help="send_delay of the gateway in ms")
+    parser.add_argument('--latency', type=float, default=0, help="reply latency of the simulator in ms")
+    parser.add_argument('--events', type=int, default=5000, help="telegrams per listener burst")
+    parser.add_argument('--split', type=int, default=0, help="cut simulator writes into fragments of this many bytes")
+    parser.add_argument('--coalesce', type=float, default=0, help="simulator write coalescing in ms")
+    parser.add_argument('--coalesce-hold', action='store_true', help="run the listener with coalesce_hold")
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 16, 64], help="device counts for memory")
+    args = parser.parse_args()
+    args.parts = args.parts or parts
+    for part in args.parts:
+        if part not in parts:
+            parser.error("unknown part %r" % part)
+
+    logging.basicConfig(level=logging.WARNING)
+    output = {'environment': _environment(), 'arguments': vars(args), 'results': asyncio.run(_run(args))}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            _compare(output, json.load(f))
@@ -0,0 +1,69 @@
+"""
+Replay a telegram capture (see bangolufsen/capture.py) through the MLGateway decoding and dispatch path, for
+offline profiling of real traffic.
+
+The gateway is not connected: received telegrams are fed straight to MLGateway._telegram_received, and events are
+fired on the same _BenchHass stand-in the benchmarks use. Login and serial number requests
+caused by the capture fail, as there is nothing to send them to.
+
+    python benchmarks/replay_capture.py capture.bin --speed 0 --profile replay.prof --devices 4
+
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from bangolufsen.capture import replay   # noqa: E402
+from bench_mlgw import SOURCES, _BenchHass   # noqa: E402
+
+
+async def _replay( args ):
+    from bangolufsen import media_player
+
+    hass = _BenchHass()
+    gateway = media_player.MLGateway('replay', 0, 'admin', 'admin', SOURCES[0], SOURCES, hass,
+                                     coalesce_hold=args.coalesce_hold)
+    gateway.telegramlogging = False
+    speakers = [media_player.BeoSpeaker(i + 1, 'speaker%d' % (i + 1), gateway) for i in range(args.devices)]
+    gateway.set_devices(speakers)
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    count = await replay(args.path, gateway._telegram_received, args.speed)
+    while len(gateway._ingest):
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)    # fire the last batch of events
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    elapsed = time.perf_counter() - start
+    return {
+        'telegrams': count,
+        'seconds': elapsed,
+        'telegrams_per_second': count / elapsed if elapsed else None,
+        'events': dict(hass.bus.fired),
+        'dropped': gateway.metrics_snapshot()['ingest_dropped_by_type'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a telegram capture through MLGateway")
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=1.0, help="1: as recorded, 0: as fast as possible")
+    parser.add_argument('--devices', type=int, default=8, help="number of devices (MLN 1 and up)")
+    parser.add_argument('--coalesce-hold', action='store_true')
+    parser.add_argument('--profile', help="write cProfile statistics to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    json.dump(asyncio.run(_replay(args)), sys.stdout, indent=2)
+    print()
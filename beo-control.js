@@ -18,14 +18,12 @@ class BeoControl extends HTMLElement {
   set hass(hass) {
     this._hass = hass;
     const entity = hass.states[this._config.entity];
-    if (entity && entity.state != this._state) {
-      this._state = entity.state;
-      if (entity.attributes != this._attributes) this._attributes = entity.attributes;
-      this._render(entity);
-    } else if (entity && entity.attributes != this._attributes) {
-      this._attributes = entity.attributes;
-      this._render(entity);
-    }
+    // Home Assistant replaces the state object when anything about the entity changes
+    if (!entity || entity === this._entity) return;
+    this._entity = entity;
+    this._state = entity.state;
+    this._attributes = entity.attributes;
+    this._update();
   }
 
   setConfig(config) {
@@ -44,73 +42,113 @@ class BeoControl extends HTMLElement {
       content.setAttribute('group', 'true');
       this._card.setAttribute('style', 'box-shadow: none; background: none;');
     }
+    if (config.title) this._card.header = config.title;
     this._card.style.cursor = config.more_info ? 'pointer' : 'default';
+    this._card.addEventListener('click', e => {
+      e.stopPropagation();
+      if (this._config.more_info) {
+        this._fire('hass-more-info', { entityId: this._config.entity });
+      };
+    });
     this._card.appendChild(this._renderStyle());
     this._card.appendChild(content);
     root.appendChild(this._card);
     this._config = Object.assign({}, config);
+    this._elements = null;
+    this._shown = {};
   }
 
-  _render(entity) {
-    const config = this._config;
-    const root = this.shadowRoot;
-    const card = root.lastChild;
-
-    if (config.title) card.header = config.title;
-    if (!config.icon) {
-      this._config.icon = this._attributes['icon'] || 'mdi:cast';
-    }
-
-    if (this._state) {
-      root.getElementById('content').innerHTML = `
-        <div class='flex justify'>
-          <div>
-            ${this._renderIcon()}
-            ${this._renderMediaInfo()}
-          </div>
-          ${this._state !== 'off' && this._state !== 'unavailable' ? this._renderBeoControls() : '' }
-          <div>
-            ${this._state == 'unavailable' ?
-              `<span class='status'>Unavailable</span>`
-            :
-              `<paper-icon-button class='power' icon='${this._icons["power"]}'></paper-icon-button>`
-            }
-          </div>
-        </div>
-      `;
+  // The values the card shows. The DOM is built once, and then only the parts showing a value that changed are
+  // updated, so state pushes that change nothing shown cost nothing.
+  _view() {
+    const on = this._state !== 'off' && this._state !== 'unavailable';
+    return {
+      state: this._state,
+      picture: this._getAttribute('entity_picture'),
+      icon: this._config.icon || this._attributes.icon || 'mdi:cast',
+      name: this._getAttribute('friendly_name'),
+      title: this._getAttribute('media_title'),
+      artist: this._getAttribute('media_artist'),
+      source: on ? this._getAttribute('source') : ''
+    };
+  }
 
-      card.addEventListener('click', e => {
-        e.stopPropagation();
-        if (this._config.more_info) {
-          this._fire('hass-more-info', { entityId: this._config.entity });
-        };
-      });
-      if (this._state !== 'unavailable') {
-        let power = card.querySelector('.power');
-        power.addEventListener('click', e => this._toggle(e));
+  _update() {
+    if (!this._state) return;
+    if (!this._elements) this._build();
+    const view = this._view();
+    const shown = this._shown;
+    const el = this._elements;
+    const changed = key => view[key] !== shown[key];
 
-        if (this._state !== 'off') this._setupBeoControls();
-      };
+    if (changed('picture') || changed('icon')) {
+      el.artwork.style.backgroundImage = view.picture ? `url("${view.picture}")` : '';
+      el.icon.hidden = !!view.picture;
+      el.icon.setAttribute('icon', view.icon);
     }
-  }
-
-  _renderIcon() {
-    if (this._attributes.entity_picture && this._attributes.entity_picture != '') {
-      return `<div class='artwork' style='background-image: url("${this._attributes.entity_picture}")'></div>`;
-    } else {
-      return `<div class='artwork'><ha-icon icon='${this._config.icon}'> </ha-icon></div>`;
+    if (changed('name')) el.name.textContent = view.name;
+    if (changed('title')) {
+      el.title.textContent = view.title;
+      el.title.hidden = !view.title;
+    }
+    if (changed('artist')) {
+      el.artist.textContent = `- ${view.artist}`;
+      el.artist.hidden = !view.artist;
     }
+    if (changed('source')) el.source.textContent = view.source;
+    if (changed('source') || changed('title')) el.source.hidden = !view.source || !!view.title;
+    if (changed('title') || changed('artist') || changed('source')) {
+      if (view.title || view.artist || view.source) {
+        el.name.setAttribute('has-info', 'true');
+      } else {
+        el.name.removeAttribute('has-info');
+      }
+    }
+    if (changed('state')) {
+      const unavailable = view.state === 'unavailable';
+      el.controls.hidden = unavailable || view.state === 'off';
+      el.status.hidden = !unavailable;
+      el.power.hidden = unavailable;
+    }
+    this._shown = view;
   }
 
-  _renderMediaInfo() {
-    return `
-      <div class='info'>
-        <div class='playername' ${this._hasMediaInfo() ? `has-info='true'` : '' } >${this._getAttribute('friendly_name')}</div>
-        <div class='mediainfo'>
-          ${this._hasAttribute('media_title') ? `<span class='mediatitle'>${this._getAttribute('media_title')}</span>` : '' }
-          ${this._hasAttribute('media_artist') ? `<span class='mediaartist'>- ${this._getAttribute('media_artist')}</span>` : '' }
+  _build() {
+    const content = this.shadowRoot.getElementById('content');
+    content.innerHTML = `
+      <div class='flex justify'>
+        <div>
+          <div class='artwork'><ha-icon></ha-icon></div>
+          <div class='info'>
+            <div class='playername'></div>
+            <div class='mediainfo'>
+              <span class='mediatitle' hidden></span>
+              <span class='mediaartist' hidden></span>
+              <span class='source' hidden></span>
+            </div>
+          </div>
         </div>
-      </div>`;
+        ${this._renderBeoControls()}
+        <div>
+          <span class='status' hidden>Unavailable</span>
+          <paper-icon-button class='power' icon='${this._icons["power"]}'></paper-icon-button>
+        </div>
+      </div>
+    `;
+    const find = selector => content.querySelector(selector);
+    this._elements = {
+      artwork: find('.artwork'),
+      icon: find('ha-icon'),
+      name: find('.playername'),
+      title: find('.mediatitle'),
+      artist: find('.mediaartist'),
+      source: find('.source'),
+      controls: find('.beocontrols'),
+      status: find('.status'),
+      power: find('.power')
+    };
+    this._elements.power.addEventListener('click', e => this._toggle(e));
+    this._setupBeoControls();
   }
 
   _renderMediaControls() {
@@ -134,7 +172,7 @@ class BeoControl extends HTMLElement {
 
   _renderBeoControls() {
     return `
-      <div class='flex'>
+      <div class='flex beocontrols'>
         <paper-icon-button class='volume_down' icon='${this._icons["volume_down"]}'></paper-icon-button>
         <paper-icon-button class='volume_up' icon='${this._icons["volume_up"]}'></paper-icon-button>
       </div>`;
@@ -210,17 +248,6 @@ class BeoControl extends HTMLElement {
     return e;
   }
 
-  _hasMediaInfo() {
-    if (this._attributes.media_title && this._attributes.media_title !== '') return true;
-    if (this._attributes.media_artist && this._attributes.media_artist !== '') return true;
-    return false;
-  }
-
-  _hasAttribute(attr) {
-    if (this._attributes[attr] && this._attributes[attr] !== '') return true;
-    return false;
-  }
-
   _getAttribute(attr) {
     return this._attributes[attr] || '';
   }
@@ -234,6 +261,9 @@ class BeoControl extends HTMLElement {
       #content[group] {
         padding: 0;
       }
+      [hidden] {
+        display: none !important;
+      }
       .flex {
         display: flex;
         display: -ms-flexbox;